@@ -0,0 +1,76 @@
+import argparse
+import time
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+from psf_analysis_upload import ROW_COLUMNS_V0, ROW_COLUMNS_V1, \
+    OPTIONAL_FIELDS_V0, OPTIONAL_FIELDS, create_row, convert_rows
+
+
+def synthetic_results(n_rows: int, version: str, seed: int = 0):
+    """Result CSV of napari-psf-analysis with random measurements."""
+    rng = np.random.default_rng(seed)
+    if version.startswith("0."):
+        columns, optional_fields = ROW_COLUMNS_V0, OPTIONAL_FIELDS_V0
+    else:
+        columns, optional_fields = ROW_COLUMNS_V1, OPTIONAL_FIELDS
+
+    data = {}
+    for column in columns:
+        data[column] = rng.normal(100, 10, n_rows)
+    data["ImageName"] = [f"psf_{i:05d}.tif" for i in range(n_rows)]
+    data["Date"] = "2023-01-01"
+    data["Microscope"] = "Microscope"
+    data["Magnification"] = rng.choice([20, 40, 60, 100], n_rows)
+    data["version"] = version
+    for name, cast in optional_fields:
+        if cast is str:
+            data[name] = rng.choice(["a", "b", None], n_rows)
+        elif cast is int:
+            data[name] = rng.integers(0, 1000, n_rows)
+        else:
+            data[name] = rng.normal(1, 0.1, n_rows)
+
+    # Round trip through a CSV to get the dtypes of a real result file.
+    buffer = StringIO()
+    pd.DataFrame(data).to_csv(buffer, index=False)
+    buffer.seek(0)
+    return pd.read_csv(buffer)
+
+
+def benchmark(n_rows, versions):
+    print(f"{'rows':>6} {'version':>8} {'per-row [s]':>12} "
+          f"{'vectorized [s]':>15} {'speed-up':>9} {'identical':>10}")
+    for n in n_rows:
+        for version in versions:
+            data = synthetic_results(n, version)
+
+            start = time.perf_counter()
+            per_row = [create_row(data, i) for i in range(len(data))]
+            per_row_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            vectorized = convert_rows(data)
+            vectorized_time = time.perf_counter() - start
+
+            identical = pd.DataFrame(per_row).equals(pd.DataFrame(vectorized))
+            print(f"{n:>6} {version:>8} {per_row_time:>12.2f} "
+                  f"{vectorized_time:>15.3f} "
+                  f"{per_row_time / vectorized_time:>9.1f} "
+                  f"{str(identical):>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the per-row and the vectorized conversion of "
+                    "PSF analysis results to Airtable records on synthetic "
+                    "result CSVs.")
+    parser.add_argument("--rows", type=int, nargs="+",
+                        default=[1000, 5000])
+    parser.add_argument("--versions", nargs="+",
+                        default=["0.1.0", "1.0.0"])
+    args = parser.parse_args()
+
+    benchmark(n_rows=args.rows, versions=args.versions)
@@ -1,16 +1,253 @@
 import configparser
+import hashlib
+import json
+import sqlite3
+import threading
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from glob import glob
-from os.path import join, dirname, basename
+from itertools import repeat
+from os.path import join, dirname, basename, exists
 from shutil import move
 from typing import List, Dict
 
 import cloudinary
+import numpy as np
 import pandas as pd
 from prefect import flow, task
 from prefect.task_runners import SequentialTaskRunner
 from pyairtable import Api
 
+# Maximum number of records per Airtable create request.
+AIRTABLE_BATCH_SIZE = 10
+# Maximum number of records checked for thumbnails per list request.
+READY_CHECK_BATCH_SIZE = 100
+# Maximum number of cloudinary assets deleted per request.
+CLOUDINARY_DELETE_BATCH_SIZE = 100
+# Fields which identify the record of a result row.
+RECORD_KEY_FIELDS = ["ImageName", "Date", "Microscope"]
+
+# Journal of the upload stages, stored in the upload directory.
+JOURNAL_NAME = "upload-journal.sqlite"
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    csv TEXT, row INTEGER, stage TEXT, value TEXT
+);
+"""
+# Upload stages of a row in the order they are done.
+STAGES = ["uploaded", "created", "ready", "destroyed", "moved"]
+
+# Columns of the result CSV of napari-psf-analysis < 1.0.
+ROW_COLUMNS_V0 = [
+    "ImageName",
+    "Date",
+    "Microscope",
+    "Magnification",
+    "NA",
+    "Amplitude",
+    "Amplitude_2D",
+    "Background",
+    "Background_2D",
+    "X",
+    "Y",
+    "Z",
+    "X_2D",
+    "Y_2D",
+    "FWHM_X",
+    "FWHM_Y",
+    "FWHM_Z",
+    "FWHM_X_2D",
+    "FWHM_Y_2D",
+    "PrincipalAxis_1",
+    "PrincipalAxis_2",
+    "PrincipalAxis_3",
+    "PrincipalAxis_1_2D",
+    "PrincipalAxis_2_2D",
+    "SignalToBG",
+    "SignalToBG_2D",
+    "XYpixelsize",
+    "Zspacing",
+    "cov_xx",
+    "cov_xy",
+    "cov_xz",
+    "cov_yy",
+    "cov_yz",
+    "cov_zz",
+    "cov_xx_2D",
+    "cov_xy_2D",
+    "cov_yy_2D",
+    "sde_peak",
+    "sde_background",
+    "sde_X",
+    "sde_Y",
+    "sde_Z",
+    "sde_cov_xx",
+    "sde_cov_xy",
+    "sde_cov_xz",
+    "sde_cov_yy",
+    "sde_cov_yz",
+    "sde_cov_zz",
+    "sde_peak_2D",
+    "sde_background_2D",
+    "sde_X_2D",
+    "sde_Y_2D",
+    "sde_cov_xx_2D",
+    "sde_cov_xy_2D",
+    "sde_cov_yy_2D",
+    "version",
+]
+
+# Columns of the result CSV of napari-psf-analysis >= 1.0.
+ROW_COLUMNS_V1 = [
+    "ImageName",
+    "Date",
+    "Microscope",
+    "Magnification",
+    "NA",
+    "Amplitude_1D_Z",
+    "Amplitude_2D_XY",
+    "Amplitude_3D_XYZ",
+    "Background_1D_Z",
+    "Background_2D_XY",
+    "Background_3D_XYZ",
+    "Z_1D",
+    "X_2D",
+    "Y_2D",
+    "X_3D",
+    "Y_3D",
+    "Z_3D",
+    "FWHM_1D_Z",
+    "FWHM_2D_X",
+    "FWHM_2D_Y",
+    "FWHM_3D_Z",
+    "FWHM_3D_Y",
+    "FWHM_3D_X",
+    "FWHM_PA1_2D",
+    "FWHM_PA2_2D",
+    "FWHM_PA1_3D",
+    "FWHM_PA2_3D",
+    "FWHM_PA3_3D",
+    "SignalToBG_1D_Z",
+    "SignalToBG_2D_XY",
+    "SignalToBG_3D_XYZ",
+    "XYpixelsize",
+    "Zspacing",
+    "cov_xx_3D",
+    "cov_xy_3D",
+    "cov_xz_3D",
+    "cov_yy_3D",
+    "cov_yz_3D",
+    "cov_zz_3D",
+    "cov_xx_2D",
+    "cov_xy_2D",
+    "cov_yy_2D",
+    "sde_amp_1D_Z",
+    "sde_amp_2D_XY",
+    "sde_amp_3D_XYZ",
+    "sde_background_1D_Z",
+    "sde_background_2D_XY",
+    "sde_background_3D_XYZ",
+    "sde_Z_1D",
+    "sde_X_2D",
+    "sde_Y_2D",
+    "sde_X_3D",
+    "sde_Y_3D",
+    "sde_Z_3D",
+    "sde_cov_xx_3D",
+    "sde_cov_xy_3D",
+    "sde_cov_xz_3D",
+    "sde_cov_yy_3D",
+    "sde_cov_yz_3D",
+    "sde_cov_zz_3D",
+    "sde_cov_xx_2D",
+    "sde_cov_xy_2D",
+    "sde_cov_yy_2D",
+    "version",
+]
+
+# Optional columns and their types. Missing columns are uploaded as None.
+OPTIONAL_FIELDS = [
+    ("Objective_id", str),
+    ("Temperature", int),
+    ("AiryUnit", int),
+    ("BeadSize", int),
+    ("BeadSupplier", str),
+    ("MountingMedium", str),
+    ("Operator", str),
+    ("MicroscopeType", str),
+    ("Excitation", int),
+    ("Emission", int),
+    ("Comment", str),
+    ("End date", str),
+]
+OPTIONAL_FIELDS_V0 = [
+    ("sde_fwhm_x", float),
+    ("sde_fwhm_y", float),
+    ("sde_fwhm_z", float),
+] + OPTIONAL_FIELDS
+
+# Airtable field names of the columns of ROW_COLUMNS_V0.
+V0_FIELD_NAMES = {
+    "ImageName": "ImageName",
+    "Date": "Date",
+    "Microscope": "Microscope",
+    "Magnification": "Magnification",
+    "NA": "NA",
+    "Amplitude": "Amplitude_3D_XYZ",
+    "Amplitude_2D": "Amplitude_2D_XY",
+    "Background": "Background_3D_XYZ",
+    "Background_2D": "Background_2D_XY",
+    "X": "X_3D",
+    "Y": "Y_3D",
+    "Z": "Z_3D",
+    "X_2D": "X_2D",
+    "Y_2D": "Y_2D",
+    "FWHM_X": "FWHM_3D_X",
+    "FWHM_Y": "FWHM_3D_Y",
+    "FWHM_Z": "FWHM_3D_Z",
+    "FWHM_X_2D": "FWHM_2D_X",
+    "FWHM_Y_2D": "FWHM_2D_Y",
+    "PrincipalAxis_1": "FWHM_PA1_3D",
+    "PrincipalAxis_2": "FWHM_PA2_3D",
+    "PrincipalAxis_3": "FWHM_PA3_3D",
+    "PrincipalAxis_1_2D": "FWHM_PA1_2D",
+    "PrincipalAxis_2_2D": "FWHM_PA2_2D",
+    "SignalToBG": "SignalToBG_3D_XYZ",
+    "SignalToBG_2D": "SignalToBG_2D_XY",
+    "XYpixelsize": "XYpixelsize",
+    "Zspacing": "Zspacing",
+    "cov_xx": "cov_xx_3D",
+    "cov_xy": "cov_xy_3D",
+    "cov_xz": "cov_xz_3D",
+    "cov_yy": "cov_yy_3D",
+    "cov_yz": "cov_yz_3D",
+    "cov_zz": "cov_zz_3D",
+    "cov_xx_2D": "cov_xx_2D",
+    "cov_xy_2D": "cov_xy_2D",
+    "cov_yy_2D": "cov_yy_2D",
+    "sde_peak": "sde_amp_3D_XYZ",
+    "sde_background": "sde_background_3D_XYZ",
+    "sde_X": "sde_X_3D",
+    "sde_Y": "sde_Y_3D",
+    "sde_Z": "sde_Z_3D",
+    "sde_cov_xx": "sde_cov_xx_3D",
+    "sde_cov_xy": "sde_cov_xy_3D",
+    "sde_cov_xz": "sde_cov_xz_3D",
+    "sde_cov_yy": "sde_cov_yy_3D",
+    "sde_cov_yz": "sde_cov_yz_3D",
+    "sde_cov_zz": "sde_cov_zz_3D",
+    "sde_peak_2D": "sde_amp_2D_XY",
+    "sde_background_2D": "sde_background_2D_XY",
+    "sde_X_2D": "sde_X_2D",
+    "sde_Y_2D": "sde_Y_2D",
+    "sde_cov_xx_2D": "sde_cov_xx_2D",
+    "sde_cov_xy_2D": "sde_cov_xy_2D",
+    "sde_cov_yy_2D": "sde_cov_yy_2D",
+    "version": "version",
+}
+
 
 def load_airtable_config(path):
     airtable_config = configparser.ConfigParser()
@@ -45,168 +282,348 @@ def connect_to_cloudinary(path):
 
 
 def rename_columns(row: dict):
-    renamed = {
-        "ImageName": row["ImageName"],
-        "Date": row["Date"],
-        "Microscope": row["Microscope"],
-        "Magnification": row["Magnification"],
-        "NA": row["NA"],
-        "Amplitude_3D_XYZ": row["Amplitude"],
-        "Amplitude_2D_XY": row["Amplitude_2D"],
-        "Background_3D_XYZ": row["Background"],
-        "Background_2D_XY": row["Background_2D"],
-        "X_3D": row["X"],
-        "Y_3D": row["Y"],
-        "Z_3D": row["Z"],
-        "X_2D": row["X_2D"],
-        "Y_2D": row["Y_2D"],
-        "FWHM_3D_X": row["FWHM_X"],
-        "FWHM_3D_Y": row["FWHM_Y"],
-        "FWHM_3D_Z": row["FWHM_Z"],
-        "FWHM_2D_X": row["FWHM_X_2D"],
-        "FWHM_2D_Y": row["FWHM_Y_2D"],
-        "FWHM_PA1_3D": row["PrincipalAxis_1"],
-        "FWHM_PA2_3D": row["PrincipalAxis_2"],
-        "FWHM_PA3_3D": row["PrincipalAxis_3"],
-        "FWHM_PA1_2D": row["PrincipalAxis_1_2D"],
-        "FWHM_PA2_2D": row["PrincipalAxis_2_2D"],
-        "SignalToBG_3D_XYZ": row["SignalToBG"],
-        "SignalToBG_2D_XY": row["SignalToBG_2D"],
-        "XYpixelsize": row["XYpixelsize"],
-        "Zspacing": row["Zspacing"],
-        "cov_xx_3D": row["cov_xx"],
-        "cov_xy_3D": row["cov_xy"],
-        "cov_xz_3D": row["cov_xz"],
-        "cov_yy_3D": row["cov_yy"],
-        "cov_yz_3D": row["cov_yz"],
-        "cov_zz_3D": row["cov_zz"],
-        "cov_xx_2D": row["cov_xx_2D"],
-        "cov_xy_2D": row["cov_xy_2D"],
-        "cov_yy_2D": row["cov_yy_2D"],
-        "sde_amp_3D_XYZ": row["sde_peak"],
-        "sde_background_3D_XYZ": row["sde_background"],
-        "sde_X_3D": row["sde_X"],
-        "sde_Y_3D": row["sde_Y"],
-        "sde_Z_3D": row["sde_Z"],
-        "sde_cov_xx_3D": row["sde_cov_xx"],
-        "sde_cov_xy_3D": row["sde_cov_xy"],
-        "sde_cov_xz_3D": row["sde_cov_xz"],
-        "sde_cov_yy_3D": row["sde_cov_yy"],
-        "sde_cov_yz_3D": row["sde_cov_yz"],
-        "sde_cov_zz_3D": row["sde_cov_zz"],
-        "sde_amp_2D_XY": row["sde_peak_2D"],
-        "sde_background_2D_XY": row["sde_background_2D"],
-        "sde_X_2D": row["sde_X_2D"],
-        "sde_Y_2D": row["sde_Y_2D"],
-        "sde_cov_xx_2D": row["sde_cov_xx_2D"],
-        "sde_cov_xy_2D": row["sde_cov_xy_2D"],
-        "sde_cov_yy_2D": row["sde_cov_yy_2D"],
-        "version": row["version"],
-    }
-    return renamed
-
-
-
-def upload(path, table, uploaded_dir):
-    data = pd.read_csv(path)
-    for i in range(len(data)):
-        img_name = join(dirname(path), basename(data.iloc[i]["PSF_path"]))
-        import cloudinary.uploader
-        response = cloudinary.uploader.upload(img_name)
+    return {new: row[old] for old, new in V0_FIELD_NAMES.items()}
+
+
+class RateLimiter:
+    """Space out calls from all threads to `rate` calls per second.
+
+    Airtable allows 5 requests per second per base.
+    """
+
+    def __init__(self, rate: float = 5):
+        self.interval = 1 / rate
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def create_row(data, i):
+    version = data.iloc[i]["version"]
+
+    if version.startswith("0."):
+        row = create_row_v0(data, i)
+        return rename_columns(row)
+    else:
+        return create_row_v1(data, i)
+
+
+def convert_rows(data: pd.DataFrame):
+    """Convert all rows of a result CSV to Airtable records at once.
+
+    Gives the same records as `create_row`, but selects, casts and renames
+    whole columns instead of indexing every row.
+    """
+    is_v0 = data["version"].str.startswith("0.").to_numpy(dtype=bool)
+    rows = [None] * len(data)
+    for mask, columns, optional_fields in [
+        (is_v0, ROW_COLUMNS_V0, OPTIONAL_FIELDS_V0),
+        (~is_v0, ROW_COLUMNS_V1, OPTIONAL_FIELDS),
+    ]:
+        if not mask.any():
+            continue
+
+        subset = data[mask]
+        converted = subset[columns].copy()
+        for name, cast in optional_fields:
+            if name in subset.columns:
+                converted[name] = subset[name].map(cast)
+            else:
+                converted[name] = None
+
+        converted["Magnification"] = converted["Magnification"].map(str)
+        if columns is ROW_COLUMNS_V0:
+            converted = converted[list(V0_FIELD_NAMES.keys())].rename(
+                columns=V0_FIELD_NAMES)
+
+        for i, row in zip(np.flatnonzero(mask),
+                          converted.to_dict(orient="records")):
+            rows[i] = row
+
+    return rows
+
+
+def add_image_url(row, response):
+    # Provide the url of the PSF image.
+    # Airtable will fetch the image from there.
+    # Direct image upload is not supported by the Airtable API.
+    row['PSF_Image'] = [{'url': response['secure_url']}]
+    return row
 
-        version = data.iloc[i]["version"]
 
-        if version.startswith("0."):
-            row = create_row_v0(data, i)
-            row = rename_columns(row)
-        else:
-            row = create_row_v1(data, i)
+def journal_key(path):
+    """Identify a result CSV in the journal by its name and content.
 
-        # Provide the url of the PSF image.
-        # Airtable will fetch the image from there.
-        # Direct image upload is not supported by the Airtable API.
-        row['PSF_Image'] = [{'url': response['secure_url']}]
+    Stale entries of an earlier CSV with the same name never match.
+    """
+    with open(path, "rb") as f:
+        return f"{basename(path)}:{hashlib.sha256(f.read()).hexdigest()}"
 
-        # Create a new entry in the Airtable table.
-        row_id = table.create(row)['id']
 
-        # Probing if the thumbnail has been created.
-        # If the thumbnail is there, it means that Airtable has downloaded the
-        # image from cloudinary.
-        rec = table.get(row_id)
-        while not 'thumbnails' in rec['fields']['PSF_Image'][0].keys():
-            time.sleep(1)
-            rec = table.get(row_id)
+class UploadJournal:
+    """Append-only log of the upload stages of the rows of a result CSV.
 
-        # Delete the image from cloudinary.
-        cloudinary.uploader.destroy(response['public_id'])
+    Each stage of a row (see `STAGES`) is committed as soon as it is done.
+    A rerun after a crash skips everything the journal already contains.
+    `csv` identifies the result CSV, see `journal_key`.
+    """
 
-        # Move the uploaded image to the uploaded directory.
-        move(img_name, join(uploaded_dir,
-                            basename(img_name)))
+    def __init__(self, con: sqlite3.Connection, csv: str):
+        self.con = con
+        self.csv = csv
+        self.lock = threading.Lock()
+        self.stages = defaultdict(dict)
+        for i, stage, value in con.execute(
+                "SELECT row, stage, value FROM journal WHERE csv = ?",
+                (csv,)):
+            self.stages[i][stage] = value
+
+    def done(self, i, stage):
+        return stage in self.stages[i]
+
+    def get(self, i, stage):
+        return self.stages[i][stage]
+
+    def log(self, entries):
+        """Append (row, stage, value) entries."""
+        entries = list(entries)
+        with self.lock, self.con:
+            self.con.executemany("INSERT INTO journal VALUES (?, ?, ?, ?)",
+                                 [(self.csv, i, stage, value)
+                                  for i, stage, value in entries])
+            for i, stage, value in entries:
+                self.stages[i][stage] = value
+
+    def clear(self):
+        with self.lock, self.con:
+            self.con.execute("DELETE FROM journal WHERE csv = ?",
+                             (self.csv,))
+            self.stages.clear()
+
+
+def upload_image(i, img_name, journal):
+    """Upload an image to cloudinary unless the journal has it already."""
+    if not journal.done(i, "uploaded"):
+        import cloudinary.uploader
+        response = cloudinary.uploader.upload(img_name)
+        journal.log([(i, "uploaded", json.dumps({
+            'public_id': response['public_id'],
+            'secure_url': response['secure_url'],
+        }))])
+
+    return json.loads(journal.get(i, "uploaded"))
+
+
+def release_images(indices, img_names, uploaded_dir, journal):
+    """Delete uploaded images from cloudinary and move them locally."""
+    import cloudinary.api
+    to_destroy = [(i, json.loads(journal.get(i, "uploaded"))['public_id'])
+                  for i in indices if not journal.done(i, "destroyed")]
+    for start in range(0, len(to_destroy), CLOUDINARY_DELETE_BATCH_SIZE):
+        chunk = to_destroy[start:start + CLOUDINARY_DELETE_BATCH_SIZE]
+        cloudinary.api.delete_resources([public_id for _, public_id in chunk])
+        journal.log((i, "destroyed", None) for i, _ in chunk)
+
+    # Move the uploaded images to the uploaded directory.
+    # Images moved by a run which crashed before logging it are gone already.
+    for i in indices:
+        if not journal.done(i, "moved"):
+            if exists(img_names[i]):
+                move(img_names[i], join(uploaded_dir,
+                                        basename(img_names[i])))
+            journal.log([(i, "moved", None)])
+
+
+class ThumbnailTracker:
+    """Wait until Airtable has created the thumbnails of pending records.
+
+    If the thumbnail is there, it means that Airtable has downloaded the
+    image from cloudinary. All pending records are checked together with one
+    filtered list request per `READY_CHECK_BATCH_SIZE` records. The interval
+    between checks doubles up to `max_interval` seconds, and a
+    `TimeoutError` is raised if records are still pending after `timeout`
+    seconds.
+    """
+
+    def __init__(self, table, limiter, timeout: float = 600,
+                 interval: float = 1, max_interval: float = 30):
+        self.table = table
+        self.limiter = limiter
+        self.timeout = timeout
+        self.interval = interval
+        self.max_interval = max_interval
+        self.pending = {}
+
+    def add(self, row_id, key):
+        self.pending[row_id] = key
+
+    def check(self):
+        """Return the ids of all pending records with a thumbnail."""
+        row_ids = list(self.pending.keys())
+        ready = []
+        for start in range(0, len(row_ids), READY_CHECK_BATCH_SIZE):
+            formula = "OR({})".format(",".join(
+                f"RECORD_ID()='{row_id}'"
+                for row_id in row_ids[start:start + READY_CHECK_BATCH_SIZE]))
+            self.limiter.wait()
+            for rec in self.table.all(formula=formula, fields=['PSF_Image']):
+                images = rec['fields'].get('PSF_Image', [])
+                if len(images) > 0 and 'thumbnails' in images[0].keys():
+                    ready.append(rec['id'])
+
+        return ready
+
+    def wait(self, release):
+        """Call `release` with the keys of the records as they get ready."""
+        deadline = time.monotonic() + self.timeout
+        interval = self.interval
+        while len(self.pending) > 0:
+            ready = self.check()
+            if len(ready) > 0:
+                release([self.pending.pop(row_id) for row_id in ready])
+
+            if len(self.pending) == 0:
+                break
+
+            if time.monotonic() + interval > deadline:
+                raise TimeoutError(
+                    f"No thumbnail after {self.timeout} s for records "
+                    f"{', '.join(self.pending.keys())}.")
+
+            time.sleep(interval)
+            interval = min(2 * interval, self.max_interval)
+
+
+def quote(value: str):
+    """Quote a string for an Airtable formula."""
+    return "'{}'".format(value.replace("\\", "\\\\").replace("'", "\\'"))
+
+
+def record_key(fields):
+    return tuple(str(fields.get(name)) for name in RECORD_KEY_FIELDS)
+
+
+def find_created_records(indices, rows, table, limiter):
+    """Find records which were created but not logged in the journal.
+
+    A run can crash after Airtable created a record and before the journal
+    logged it. Such records are looked up by `ImageName`, with one filtered
+    list request per `READY_CHECK_BATCH_SIZE` rows, and matched to a row
+    on all `RECORD_KEY_FIELDS`. Rows whose key is shared with another row
+    in `indices` or which match zero or several records are left to be
+    created. Returns (row, record id) pairs.
+    """
+    rows_by_key = defaultdict(list)
+    for i in indices:
+        rows_by_key[record_key(rows[i])].append(i)
+    unique = {key: matches[0] for key, matches in rows_by_key.items()
+              if len(matches) == 1}
+
+    records_by_key = defaultdict(list)
+    names = sorted({rows[i]["ImageName"] for i in unique.values()})
+    for start in range(0, len(names), READY_CHECK_BATCH_SIZE):
+        formula = "OR({})".format(",".join(
+            f"{{ImageName}}={quote(name)}"
+            for name in names[start:start + READY_CHECK_BATCH_SIZE]))
+        limiter.wait()
+        for rec in table.all(formula=formula, fields=RECORD_KEY_FIELDS):
+            records_by_key[record_key(rec['fields'])].append(rec['id'])
+
+    return [(i, records_by_key[key][0]) for key, i in unique.items()
+            if len(records_by_key[key]) == 1]
+
+
+def upload_row(i, row, img_name, table, limiter, journal):
+    response = upload_image(i, img_name, journal)
+    row = add_image_url(row, response)
+
+    # Create a new entry in the Airtable table.
+    limiter.wait()
+    row_id = table.create(row)['id']
+    journal.log([(i, "created", row_id)])
+
+
+def upload_batched(indices, rows, img_names, table, pool, limiter, journal):
+    """Upload all images of a CSV first, then create the records in batches.
+
+    Airtable accepts up to `AIRTABLE_BATCH_SIZE` records per request, which
+    cuts the record creation requests by that factor.
+    """
+    responses = list(pool.map(upload_image, indices,
+                              [img_names[i] for i in indices],
+                              repeat(journal)))
+    rows = [add_image_url(rows[i], response)
+            for i, response in zip(indices, responses)]
+
+    for start in range(0, len(rows), AIRTABLE_BATCH_SIZE):
+        limiter.wait()
+        records = table.batch_create(rows[start:start + AIRTABLE_BATCH_SIZE])
+        journal.log((i, "created", record['id'])
+                    for i, record in zip(indices[start:], records))
+
+
+def upload(path, table, uploaded_dir, journal, max_workers=1, limiter=None,
+           batched=False, thumbnail_timeout=600):
+    """Upload all rows of a result CSV.
+
+    Up to `max_workers` rows are uploaded to cloudinary and Airtable at the
+    same time. All Airtable requests go through `limiter` to respect the
+    rate limit. With `batched` the records are created in batches, see
+    `upload_batched`. Afterwards the thumbnails of all created records are
+    awaited together, see `ThumbnailTracker`. Stages found in `journal`
+    are not repeated. Records created by a crashed run after its last
+    journal entry are found with `find_created_records`. Rows without an
+    unambiguous match are created again in that case.
+    """
+    data = pd.read_csv(path)
+    rows = convert_rows(data)
+    img_names = [join(dirname(path), basename(p)) for p in data["PSF_path"]]
+    if limiter is None:
+        limiter = RateLimiter()
+
+    # Only rows with an uploaded image can have an unlogged record.
+    journal.log((i, "created", row_id) for i, row_id in find_created_records(
+        [i for i in range(len(rows))
+         if journal.done(i, "uploaded") and not journal.done(i, "created")],
+        rows, table, limiter))
+
+    indices = [i for i in range(len(rows)) if not journal.done(i, "created")]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        if batched:
+            upload_batched(indices, rows, img_names, table, pool, limiter,
+                           journal)
+        else:
+            futures = [pool.submit(upload_row, i, rows[i], img_names[i],
+                                   table, limiter, journal)
+                       for i in indices]
+            for future in futures:
+                future.result()
+
+    # Release rows which got ready in a previous run.
+    release_images([i for i in range(len(rows)) if journal.done(i, "ready")],
+                   img_names, uploaded_dir, journal)
+
+    def release(ready):
+        journal.log((i, "ready", None) for i in ready)
+        release_images(ready, img_names, uploaded_dir, journal)
+
+    tracker = ThumbnailTracker(table, limiter, timeout=thumbnail_timeout)
+    for i in range(len(rows)):
+        if not journal.done(i, "ready"):
+            tracker.add(journal.get(i, "created"), i)
+    tracker.wait(release)
 
 
 def create_row_v0(data, i):
     # Create table row. Handle empty comments.
-    row = data.iloc[i][
-        [
-            "ImageName",
-            "Date",
-            "Microscope",
-            "Magnification",
-            "NA",
-            "Amplitude",
-            "Amplitude_2D",
-            "Background",
-            "Background_2D",
-            "X",
-            "Y",
-            "Z",
-            "X_2D",
-            "Y_2D",
-            "FWHM_X",
-            "FWHM_Y",
-            "FWHM_Z",
-            "FWHM_X_2D",
-            "FWHM_Y_2D",
-            "PrincipalAxis_1",
-            "PrincipalAxis_2",
-            "PrincipalAxis_3",
-            "PrincipalAxis_1_2D",
-            "PrincipalAxis_2_2D",
-            "SignalToBG",
-            "SignalToBG_2D",
-            "XYpixelsize",
-            "Zspacing",
-            "cov_xx",
-            "cov_xy",
-            "cov_xz",
-            "cov_yy",
-            "cov_yz",
-            "cov_zz",
-            "cov_xx_2D",
-            "cov_xy_2D",
-            "cov_yy_2D",
-            "sde_peak",
-            "sde_background",
-            "sde_X",
-            "sde_Y",
-            "sde_Z",
-            "sde_cov_xx",
-            "sde_cov_xy",
-            "sde_cov_xz",
-            "sde_cov_yy",
-            "sde_cov_yz",
-            "sde_cov_zz",
-            "sde_peak_2D",
-            "sde_background_2D",
-            "sde_X_2D",
-            "sde_Y_2D",
-            "sde_cov_xx_2D",
-            "sde_cov_xy_2D",
-            "sde_cov_yy_2D",
-            "version",
-        ]].to_dict()
+    row = data.iloc[i][ROW_COLUMNS_V0].to_dict()
 
     def add_field(name, r, cast):
         if name in data.columns:
@@ -214,21 +631,8 @@ def create_row_v0(data, i):
         else:
             r[name] = None
 
-    add_field("sde_fwhm_x", row, float)
-    add_field("sde_fwhm_y", row, float)
-    add_field("sde_fwhm_z", row, float)
-    add_field("Objective_id", row, str)
-    add_field("Temperature", row, int)
-    add_field("AiryUnit", row, int)
-    add_field("BeadSize", row, int)
-    add_field("BeadSupplier", row, str)
-    add_field("MountingMedium", row, str)
-    add_field("Operator", row, str)
-    add_field("MicroscopeType", row, str)
-    add_field("Excitation", row, int)
-    add_field("Emission", row, int)
-    add_field("Comment", row, str)
-    add_field("End date", row, str)
+    for name, cast in OPTIONAL_FIELDS_V0:
+        add_field(name, row, cast)
     row['Magnification'] = str(row['Magnification'])
     if row["Objective_id"] is not None:
         row["Objective_id"] = str(row["Objective_id"])
@@ -237,73 +641,7 @@ def create_row_v0(data, i):
 
 def create_row_v1(data, i):
     # Create table row. Handle empty comments.
-    row = data.iloc[i][
-        [
-            "ImageName",
-            "Date",
-            "Microscope",
-            "Magnification",
-            "NA",
-            "Amplitude_1D_Z",
-            "Amplitude_2D_XY",
-            "Amplitude_3D_XYZ",
-            "Background_1D_Z",
-            "Background_2D_XY",
-            "Background_3D_XYZ",
-            "Z_1D",
-            "X_2D",
-            "Y_2D",
-            "X_3D",
-            "Y_3D",
-            "Z_3D",
-            "FWHM_1D_Z",
-            "FWHM_2D_X",
-            "FWHM_2D_Y",
-            "FWHM_3D_Z",
-            "FWHM_3D_Y",
-            "FWHM_3D_X",
-            "FWHM_PA1_2D",
-            "FWHM_PA2_2D",
-            "FWHM_PA1_3D",
-            "FWHM_PA2_3D",
-            "FWHM_PA3_3D",
-            "SignalToBG_1D_Z",
-            "SignalToBG_2D_XY",
-            "SignalToBG_3D_XYZ",
-            "XYpixelsize",
-            "Zspacing",
-            "cov_xx_3D",
-            "cov_xy_3D",
-            "cov_xz_3D",
-            "cov_yy_3D",
-            "cov_yz_3D",
-            "cov_zz_3D",
-            "cov_xx_2D",
-            "cov_xy_2D",
-            "cov_yy_2D",
-            "sde_amp_1D_Z",
-            "sde_amp_2D_XY",
-            "sde_amp_3D_XYZ",
-            "sde_background_1D_Z",
-            "sde_background_2D_XY",
-            "sde_background_3D_XYZ",
-            "sde_Z_1D",
-            "sde_X_2D",
-            "sde_Y_2D",
-            "sde_X_3D",
-            "sde_Y_3D",
-            "sde_Z_3D",
-            "sde_cov_xx_3D",
-            "sde_cov_xy_3D",
-            "sde_cov_xz_3D",
-            "sde_cov_yy_3D",
-            "sde_cov_yz_3D",
-            "sde_cov_zz_3D",
-            "sde_cov_xx_2D",
-            "sde_cov_xy_2D",
-            "sde_cov_yy_2D",
-            "version",
-        ]].to_dict()
+    row = data.iloc[i][ROW_COLUMNS_V1].to_dict()
 
     def add_field(name, r, cast):
         if name in data.columns:
@@ -311,18 +649,8 @@ def create_row_v1(data, i):
         else:
             r[name] = None
 
-    add_field("Objective_id", row, str)
-    add_field("Temperature", row, int)
-    add_field("AiryUnit", row, int)
-    add_field("BeadSize", row, int)
-    add_field("BeadSupplier", row, str)
-    add_field("MountingMedium", row, str)
-    add_field("Operator", row, str)
-    add_field("MicroscopeType", row, str)
-    add_field("Excitation", row, int)
-    add_field("Emission", row, int)
-    add_field("Comment", row, str)
-    add_field("End date", row, str)
+    for name, cast in OPTIONAL_FIELDS:
+        add_field(name, row, cast)
     row['Magnification'] = str(row['Magnification'])
     if row["Objective_id"] is not None:
         row["Objective_id"] = str(row["Objective_id"])
@@ -332,16 +660,34 @@ def create_row_v1(data, i):
 @task()
 def upload_and_move(files: List[str],
                     cloudinary_config_path: str,
-                    airtable_config: Dict):
+                    airtable_config: Dict,
+                    max_workers: int = 1,
+                    batched: bool = False,
+                    thumbnail_timeout: float = 600):
 
     uploaded_dir = airtable_config['DEFAULT']['uploaded_dir']
 
+    journal_path = join(airtable_config['DEFAULT']['upload_dir'],
+                        JOURNAL_NAME)
+
     connect_to_cloudinary(cloudinary_config_path)
     table = connect_to_table(airtable_config)
+    limiter = RateLimiter()
+
+    with closing(sqlite3.connect(journal_path,
+                                 check_same_thread=False)) as con:
+        with con:
+            con.executescript(JOURNAL_SCHEMA)
 
-    for file in files:
-        upload(file, table, uploaded_dir)
-        move(file, join(uploaded_dir, basename(file)))
+        for file in files:
+            journal = UploadJournal(con, journal_key(file))
+            upload(file, table, uploaded_dir, journal,
+                   max_workers=max_workers, limiter=limiter, batched=batched,
+                   thumbnail_timeout=thumbnail_timeout)
+            # Entries left by a crash after the move are keyed by content
+            # and never match another CSV.
+            move(file, join(uploaded_dir, basename(file)))
+            journal.clear()
 
 
 @flow(
@@ -351,10 +697,14 @@ def upload_and_move(files: List[str],
 def psf_analysis_airtable_upload(
         airtable_config_path: str = "/path/to/config",
         cloudinary_config_path: str = "/path/to/config",
+        max_workers: int = 8,
+        batched: bool = True,
+        thumbnail_timeout: float = 600,
 ):
     airtable_config = load_airtable_config(airtable_config_path)
 
     files = list_files(airtable_config)
 
     if len(files) > 0:
-        upload_and_move.submit(files, cloudinary_config_path, airtable_config)
+        upload_and_move.submit(files, cloudinary_config_path, airtable_config,
+                               max_workers, batched, thumbnail_timeout)
@@ -0,0 +1,4 @@
+import sys
+from os.path import dirname
+
+sys.path.insert(0, dirname(dirname(__file__)))
@@ -0,0 +1,79 @@
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+pytest.importorskip("cloudinary")
+pytest.importorskip("pyairtable")
+pytest.importorskip("prefect")
+
+import psf_analysis_upload  # noqa: E402
+from psf_analysis_upload import (  # noqa: E402
+    JOURNAL_SCHEMA, UploadJournal, find_created_records, journal_key)
+
+
+class FakeTable:
+    """In-memory Airtable table which evaluates ImageName formulas."""
+
+    def __init__(self, records):
+        self.records = dict(records)
+
+    def all(self, formula, fields):
+        return [{"id": row_id,
+                 "fields": {name: rec[name] for name in fields if name in rec}}
+                for row_id, rec in self.records.items()
+                if f"{{ImageName}}='{rec['ImageName']}'" in formula]
+
+
+class NoLimit:
+    def wait(self):
+        pass
+
+
+def row(name, date="2023-05-02", microscope="Microscope A"):
+    return {"ImageName": name, "Date": date, "Microscope": microscope}
+
+
+def test_find_created_records_matches_date_and_microscope():
+    rows = [row("psf_00021.tif"), row("psf_00022.tif")]
+    table = FakeTable({
+        "recOLD": row("psf_00022.tif", date="2022-11-30"),
+        "recNEW": row("psf_00021.tif"),
+    })
+
+    found = find_created_records([0, 1], rows, table, NoLimit())
+
+    assert found == [(0, "recNEW")]
+
+
+def test_find_created_records_skips_ambiguous_matches():
+    rows = [row("psf_00021.tif"), row("psf_00022.tif"), row("psf_00022.tif")]
+    table = FakeTable({
+        "rec1": row("psf_00021.tif"),
+        "rec2": row("psf_00021.tif"),
+        "rec3": row("psf_00022.tif"),
+    })
+
+    assert find_created_records([0, 1, 2], rows, table, NoLimit()) == []
+
+
+@pytest.fixture
+def journal_db(tmp_path):
+    with closing(sqlite3.connect(tmp_path / psf_analysis_upload.JOURNAL_NAME,
+                                 check_same_thread=False)) as con:
+        with con:
+            con.executescript(JOURNAL_SCHEMA)
+        yield con
+
+
+def test_journal_of_other_csv_with_same_name_does_not_match(tmp_path,
+                                                           journal_db):
+    path = tmp_path / "results.csv"
+    path.write_text("ImageName\npsf_00001.tif\n")
+    UploadJournal(journal_db, journal_key(str(path))).log(
+        [(0, "created", "recOLD")])
+
+    path.write_text("ImageName\npsf_00002.tif\n")
+    journal = UploadJournal(journal_db, journal_key(str(path)))
+
+    assert not journal.done(0, "created")
@@ -0,0 +1,136 @@
+import time
+from glob import glob
+from os.path import join, splitext, exists, getmtime
+from pathlib import Path
+from typing import List
+
+from cpr.Serializer import cpr_serializer
+from faim_prefect.prefect import get_prefect_context
+from prefect import flow, task, get_run_logger, unmapped
+from prefect.context import get_run_context
+from prefect.filesystems import LocalFileSystem
+from prefect_dask import DaskTaskRunner
+
+from eicm_flows.run_all_estimations import MedianFilter, GaussianFit, \
+    PolynomialFit, estimate_correction_matrices
+
+MATRIX_SUFFIXES = {
+    "median_filter": "_median-filtered",
+    "gaussian_fit": "_gaussian-fit",
+    "polynomial_fit": "_poly-fit",
+}
+
+
+def is_matrix(path: str):
+    return any(splitext(path)[0].endswith(suffix)
+               for suffix in MATRIX_SUFFIXES.values())
+
+
+def is_up_to_date(shading_reference: str, estimators: List[str]):
+    """True if all requested matrices exist and are newer than the reference."""
+    name, ext = splitext(shading_reference)
+    reference_mtime = getmtime(shading_reference)
+    for estimator in estimators:
+        matrix_path = f"{name}{MATRIX_SUFFIXES[estimator]}{ext}"
+        if not exists(matrix_path) or getmtime(matrix_path) < reference_mtime:
+            return False
+
+    return True
+
+
+@task()
+def find_outdated_references(root_dir: Path, pattern: str,
+                             estimators: List[str]):
+    shading_references = []
+    for reference_dir in sorted(glob(join(root_dir, pattern))):
+        for path in sorted(glob(join(reference_dir, "**", "*.tif"),
+                                recursive=True)):
+            if not is_matrix(path) and not is_up_to_date(path, estimators):
+                shading_references.append(Path(path))
+
+    return shading_references
+
+
+@flow(
+    name="EICM Batch",
+    cache_result_in_memory=False,
+    persist_result=True,
+    result_serializer=cpr_serializer(),
+    result_storage="local-file-system/eicm",
+    task_runner=DaskTaskRunner(
+        cluster_class="dask_jobqueue.SLURMCluster",
+        cluster_kwargs={
+            "account": "dlthings",
+            "queue": "main",
+            "cores": 2,
+            "processes": 1,
+            "memory": "4 GB",
+            "walltime": "4:00:00",
+            "job_extra_directives": [
+                "--ntasks=1",
+                "--output=/tungstenfs/scratch/gmicro_share/_prefect/slurm/output/%j.out",
+            ],
+            "worker_extra_args": [
+                "--lifetime",
+                "240m",
+                "--lifetime-stagger",
+                "10m",
+            ],
+            "job_script_prologue": [
+                "conda run -p /tungstenfs/scratch/gmicro_share/_prefect/miniconda3/envs/airtable python /tungstenfs/scratch/gmicro_share/_prefect/airtable/log-slurm-job.py --config /tungstenfs/scratch/gmicro/_prefect/airtable/slurm-job-log.ini"
+            ],
+        },
+        adapt_kwargs={
+            "minimum": 1,
+            "maximum": 8,
+        },
+    )
+)
+def eicm_batch(
+        root_dir: Path = Path(LocalFileSystem.load(
+            "tungsten-gmicro-hcs").basepath),
+        pattern: str = join("*", "*", "Maintenance", "Shading_Reference"),
+        median_filter: MedianFilter = MedianFilter(),
+        gaussian_fit: GaussianFit = GaussianFit(),
+        polynomial_fit: PolynomialFit = PolynomialFit(),
+):
+    logger = get_run_logger()
+    estimators = [estimator for estimator, settings in [
+        ("median_filter", median_filter),
+        ("gaussian_fit", gaussian_fit),
+        ("polynomial_fit", polynomial_fit),
+    ] if settings.apply]
+
+    shading_references = find_outdated_references(root_dir=root_dir,
+                                                  pattern=pattern,
+                                                  estimators=estimators)
+    logger.info(f"Found {len(shading_references)} shading references "
+                f"without up-to-date matrices.")
+    if len(shading_references) == 0:
+        return
+
+    # One cached task per reference, such that references with unchanged
+    # content hit the cache and a failing reference does not fail others.
+    run_context = get_run_context()
+    start = time.perf_counter()
+    futures = estimate_correction_matrices.map(
+        shading_reference=shading_references,
+        median_filter=unmapped(median_filter),
+        gaussian_fit=unmapped(gaussian_fit),
+        polynomial_fit=unmapped(polynomial_fit),
+        name=unmapped(run_context.flow.name),
+        context=unmapped(get_prefect_context(run_context)))
+    n_processed = 0
+    for shading_reference, future in zip(shading_references, futures):
+        state = future.wait()
+        if state.is_completed():
+            n_processed += 1
+        else:
+            logger.error(f"Failed to estimate the matrices of "
+                         f"{shading_reference}: {state.message}")
+
+    minutes = (time.perf_counter() - start) / 60
+
+    logger.info(f"Processed {n_processed} of {len(shading_references)} "
+                f"shading references in {minutes:.1f} min "
+                f"({n_processed / minutes:.2f} references/min).")
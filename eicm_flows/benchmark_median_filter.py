@@ -0,0 +1,54 @@
+import argparse
+import time
+
+import numpy as np
+
+from eicm_flows.median_filter_estimation import filter_median
+
+
+def synthetic_shading_reference(size: int, seed: int = 0):
+    """Smooth illumination profile with shot noise and a few hot pixels."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size] / size - 0.5
+    profile = 1000 * np.exp(-(xx ** 2 + 1.3 * yy ** 2) / 0.3) + 100
+    data = rng.poisson(profile).astype(np.float32)
+    hot_pixels = rng.integers(0, size, (2, size // 4))
+    data[hot_pixels[0], hot_pixels[1]] = 60000
+    return data
+
+
+def benchmark(sizes, filter_sizes):
+    print(f"{'size':>6} {'filter':>6} {'exact [s]':>10} "
+          f"{'downsampled [s]':>16} {'speed-up':>9} {'max rel. error':>15}")
+    for size in sizes:
+        data = synthetic_shading_reference(size)
+        for filter_size in filter_sizes:
+            timings = {}
+            results = {}
+            for method in ["exact", "downsampled"]:
+                start = time.perf_counter()
+                results[method] = filter_median(data,
+                                                filter_size=filter_size,
+                                                method=method)
+                timings[method] = time.perf_counter() - start
+
+            exact = results["exact"] / results["exact"].max()
+            approx = results["downsampled"] / results["downsampled"].max()
+            error = np.abs(approx - exact).max()
+            print(f"{size:>6} {filter_size:>6} {timings['exact']:>10.2f} "
+                  f"{timings['downsampled']:>16.2f} "
+                  f"{timings['exact'] / timings['downsampled']:>9.1f} "
+                  f"{error:>15.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the exact and the downsampled median filter "
+                    "on synthetic shading references.")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1024, 2048])
+    parser.add_argument("--filter-sizes", type=int, nargs="+",
+                        default=[31, 51, 101])
+    args = parser.parse_args()
+
+    benchmark(sizes=args.sizes, filter_sizes=args.filter_sizes)
@@ -1,5 +1,6 @@
 from pathlib import Path
 
+from cpr.Serializer import cpr_serializer
 from faim_prefect.block.choices import Choices
 from prefect import flow, get_run_logger
 from prefect.filesystems import LocalFileSystem
@@ -8,9 +9,11 @@ from pydantic import BaseModel
 
 from eicm_flows.fit_gaussian_estimation import eicm_gaussian_fit
 from eicm_flows.fit_polynomial_estimation import eicm_polynomial_fit
-from eicm_flows.median_filter_estimation import eicm_median_filter
+from eicm_flows.median_filter_estimation import eicm_median_filter, \
+    MedianFilterMethods
+from eicm_flows.run_all_estimations import submit_fused_estimations
 from eicm_flows.shading_reference_yokogawa import Microscopes, \
-    create_shading_reference_yokogawa
+    create_shading_reference_yokogawa, compute_shading_references
 
 GROUPS = Choices.load("fmi-groups").get()
 
@@ -26,10 +29,13 @@ class RawData(BaseModel):
 class MedianFilter(BaseModel):
     apply: bool = True
     filter_size: int = 3
+    method: MedianFilterMethods = "exact"
 
 
 class GaussianFit(BaseModel):
     apply: bool = True
+    bin_factor: int = 1
+    n_samples: int = 0
 
 
 class PolynomialFit(BaseModel):
@@ -42,6 +48,7 @@ class PolynomialFit(BaseModel):
     name="EICM All [Yokogawa]",
     cache_result_in_memory=False,
     persist_result=True,
+    result_serializer=cpr_serializer(),
     result_storage="local-file-system/eicm",
     task_runner=DaskTaskRunner(
         cluster_class="dask_jobqueue.SLURMCluster",
@@ -76,8 +83,26 @@ def eicm_all_yokogawa(
         raw_data: RawData = RawData(),
         median_filter: MedianFilter = MedianFilter(),
         gaussian_fit: GaussianFit = GaussianFit(),
-        polynomial_fit: PolynomialFit = PolynomialFit()
+        polynomial_fit: PolynomialFit = PolynomialFit(),
+        fused: bool = False,
 ):
+    if fused:
+        # Create the shading references, load every reference once and run
+        # all estimators on the cluster of this flow instead of starting one
+        # cluster per subflow.
+        shading_references = compute_shading_references(
+            input_dir=raw_data.input_dir,
+            microscope=raw_data.microscope,
+            z_plane=raw_data.z_plane,
+            group=raw_data.group,
+            output_dir=raw_data.output_dir
+        )
+        submit_fused_estimations(shading_references=shading_references,
+                                 median_filter=median_filter,
+                                 gaussian_fit=gaussian_fit,
+                                 polynomial_fit=polynomial_fit)
+        return
+
     shading_references = create_shading_reference_yokogawa(
         input_dir=raw_data.input_dir,
         microscope=raw_data.microscope,
@@ -88,10 +113,13 @@ def eicm_all_yokogawa(
 
     if median_filter.apply:
         eicm_median_filter(shading_references=shading_references,
-                           filter_size=median_filter.filter_size)
+                           filter_size=median_filter.filter_size,
+                           method=median_filter.method)
 
     if gaussian_fit.apply:
-        eicm_gaussian_fit(shading_references=shading_references)
+        eicm_gaussian_fit(shading_references=shading_references,
+                          bin_factor=gaussian_fit.bin_factor,
+                          n_samples=gaussian_fit.n_samples)
 
     if polynomial_fit.apply:
         eicm_polynomial_fit(shading_references=shading_references,
@@ -1,4 +1,7 @@
+import hashlib
 import json
+import os
+import time
 from datetime import datetime
 from os.path import splitext, join, basename, dirname
 from pathlib import Path
@@ -16,10 +19,55 @@ from faim_prefect.prefect import get_prefect_context
 from prefect import task, flow, get_run_logger
 from prefect.context import get_run_context
 from prefect_dask import DaskTaskRunner
-from tifffile import TiffFile
+from scipy.optimize import curve_fit
+from tifffile import TiffFile, memmap
 
 
-def load_tiff(path: Path):
+_CONTENT_HASHES = {}
+
+
+def file_content_hash(path: Path) -> str:
+    """Chunked hash of the file bytes, memoized by inode, mtime and size."""
+    stat = os.stat(path)
+    key = (os.fspath(path), stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if key not in _CONTENT_HASHES:
+        content_hash = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(2 ** 22), b""):
+                content_hash.update(chunk)
+
+        _CONTENT_HASHES[key] = content_hash.hexdigest()
+
+    return _CONTENT_HASHES[key]
+
+
+# Task inputs which only end up in the info markdown and change every run.
+RUN_SPECIFIC_ARGUMENTS = ("name", "context")
+
+
+def reference_content_hash(context, arguments):
+    """Cache key over the shading reference content and the task inputs.
+
+    A re-acquired shading reference at the same path invalidates the cache.
+    The path itself stays part of the key, because the matrices are written
+    next to the shading reference. `RUN_SPECIFIC_ARGUMENTS` are left out,
+    such that a repeated run hits the cache.
+    """
+    return task_input_hash(context, {
+        **{key: value for key, value in arguments.items()
+           if key not in RUN_SPECIFIC_ARGUMENTS},
+        "shading_reference_content": file_content_hash(
+            arguments["shading_reference"]),
+    })
+
+
+def load_tiff(path: Path, mmap: bool = False):
+    """Load resolution, metadata and data of a TIFF.
+
+    With `mmap` the data of uncompressed, contiguous TIFFs is memory-mapped
+    read-only instead of copied to the heap, callers must not modify it.
+    Other TIFFs are decoded.
+    """
     with TiffFile(path) as tiff:
         try:
             resolution = tiff.pages[0].resolution
@@ -33,30 +81,156 @@ def load_tiff(path: Path):
             get_run_logger().warning(f"Could not load metadata.\n{e}")
             metadata = {'axes': 'YX'}
 
-        data = tiff.asarray()
+        data = None
+        if mmap and tiff.series[0].dataoffset is not None:
+            try:
+                data = memmap(path, mode="r")
+            except ValueError as e:
+                get_run_logger().debug(f"Could not memory-map data.\n{e}")
+
+        if data is None:
+            data = tiff.asarray()
     return resolution, metadata, data
 
 
-@task(cache_key_fn=task_input_hash)
-def estimate_correction_matrix(shading_reference: Path):
+def bin_image(data: np.ndarray, bin_factor: int):
+    height = data.shape[0] // bin_factor * bin_factor
+    width = data.shape[1] // bin_factor * bin_factor
+    return data[:height, :width].reshape(height // bin_factor, bin_factor,
+                                         width // bin_factor,
+                                         bin_factor).mean(axis=(1, 3))
+
+
+def to_fit_frame(coords, bin_factor: int):
+    """Map full resolution pixel coordinates into the binned fit frame."""
+    if bin_factor == 1:
+        return coords
+
+    return (np.asarray(coords) - (bin_factor - 1) / 2) / bin_factor
+
+
+def row_shift(n_rows: int):
+    """Coordinate shift of `n_rows` image rows in the layout of `get_coords`.
+
+    The layout (pixels along the first or the last axis) is an eicm
+    implementation detail and is probed on a 3x1 image.
+    """
+    probe = np.asarray(get_coords(np.zeros((3, 1))), dtype=np.float64)
+    if probe.shape[0] == 3:
+        return n_rows * (probe[1] - probe[0])
+
+    return n_rows * (probe[:, 1] - probe[:, 0])[:, np.newaxis]
+
+
+def render_gaussian(popt: np.ndarray, shape, bin_factor: int = 1,
+                    band_height: int = 128):
+    """Evaluate the fitted Gaussian row-band by row-band.
+
+    Only the coordinates of a single band are materialized and the result
+    is written directly into a float32 buffer.
+    """
+    rendered = np.empty(shape, dtype=np.float32)
+    for start in range(0, shape[0], band_height):
+        stop = min(start + band_height, shape[0])
+        band_shape = (stop - start, shape[1])
+        coords = np.asarray(get_coords(np.empty(band_shape,
+                                                dtype=np.float32))) + \
+                 row_shift(start)
+        rendered[start:stop] = compute_fitted_matrix(
+            coords=to_fit_frame(coords, bin_factor=bin_factor),
+            ellipsoid_parameters=popt,
+            shape=band_shape)
+
+    return rendered
+
+
+def refine_gaussian_fit(data: np.ndarray, popt: np.ndarray, bin_factor: int,
+                        n_samples: int, seed: int = 0):
+    """Refine the Gaussian parameters on a full resolution pixel subsample.
+
+    The subsample is a randomly shifted lattice of roughly `n_samples`
+    pixels. The parameters stay in the coordinate frame of the binned fit.
+    """
+    stride = max(1, int(np.sqrt(data.size / n_samples)))
+    offset = np.random.default_rng(seed).integers(stride)
+    sample = data[offset::stride, offset::stride]
+    coords = to_fit_frame(np.asarray(get_coords(sample)) * stride + offset,
+                          bin_factor=bin_factor)
+
+    def model(coords, *parameters):
+        return compute_fitted_matrix(coords=coords,
+                                     ellipsoid_parameters=np.array(parameters),
+                                     shape=sample.shape).ravel()
+
+    popt, pcov = curve_fit(model, coords, sample.ravel(), p0=popt)
+    return popt, pcov, sample.size
+
+
+def fit_gaussian_coarse_to_fine(data: np.ndarray, bin_factor: int = 1,
+                                n_samples: int = 0):
+    """Fit the Gaussian on the binned image and optionally refine it.
+
+    Returns the fitted parameters in the coordinate frame of the binned
+    image (see `to_fit_frame`), their covariance and the number of pixels
+    used for the final fit.
+    """
+    binned = bin_image(data, bin_factor) if bin_factor > 1 else data
+    popt, pcov = fit_gaussian_2d(binned, get_coords(binned))
+    n_pixels = binned.size
+
+    if n_samples > 0:
+        popt, pcov, n_pixels = refine_gaussian_fit(data=data, popt=popt,
+                                                   bin_factor=bin_factor,
+                                                   n_samples=n_samples)
+
+    return popt, pcov, n_pixels
+
+
+def gaussian_fit_matrix(shading_reference: Path, resolution, metadata,
+                        data: np.ndarray, bin_factor: int = 1,
+                        n_samples: int = 0):
     n, ext = splitext(basename(shading_reference))
     save_path = join(dirname(shading_reference), f"{n}_gaussian-fit{ext}")
 
-    resolution, metadata, data = load_tiff(path=shading_reference)
-
     matrix = ImageTarget.from_path(save_path,
                                    metadata=metadata,
                                    resolution=resolution)
 
-    coords = get_coords(data)
-    popt, pcov = fit_gaussian_2d(data, coords)
+    start = time.perf_counter()
+    popt, pcov, n_pixels = fit_gaussian_coarse_to_fine(data=data,
+                                                       bin_factor=bin_factor,
+                                                       n_samples=n_samples)
+    fit_time = time.perf_counter() - start
+
+    fitted = render_gaussian(popt=popt, shape=data.shape,
+                             bin_factor=bin_factor)
+
+    fit_info = {
+        "bin_factor": bin_factor,
+        "n_samples": n_samples,
+        "fit_pixels": int(n_pixels),
+        "total_pixels": int(data.size),
+        "fit_time": fit_time,
+        "relative_rms_residual": float(
+            np.sqrt(np.mean(np.square(fitted - data))) / np.mean(data)),
+    }
 
-    matrix.set_data(normalize_matrix(compute_fitted_matrix(coords=coords,
-                                                           ellipsoid_parameters=popt,
-                                                           shape=data.shape)).astype(
-        np.float32))
+    matrix.set_data(normalize_matrix(fitted).astype(np.float32, copy=False))
 
-    return matrix, popt.tolist()
+    return matrix, popt.tolist(), fit_info
+
+
+@task(cache_key_fn=reference_content_hash)
+def estimate_correction_matrix(shading_reference: Path, bin_factor: int = 1,
+                               n_samples: int = 0):
+    resolution, metadata, data = load_tiff(path=shading_reference)
+
+    return gaussian_fit_matrix(shading_reference=shading_reference,
+                               resolution=resolution,
+                               metadata=metadata,
+                               data=data,
+                               bin_factor=bin_factor,
+                               n_samples=n_samples)
 
 
 @task(cache_key_fn=task_input_hash)
@@ -64,16 +238,18 @@ def write_gaussian_fit_info_md(result,
                                name: str,
                                shading_reference: Path,
                                context: Dict):
-    matrix, popt = result
+    matrix, popt, fit_info = result
 
     date = datetime.now().strftime("%Y/%m/%d, %H:%M:%S")
     eicm_version = pkg_resources.get_distribution("eicm").version
     flow_repo = "https://github.com/fmi-faim/prefect-workflows/blob/main/eicm_flows"
 
+    # The centroid is fitted in the coordinate frame of the binned image.
+    bin_factor = fit_info['bin_factor']
     amplitude = popt[0],
     background = popt[1],
-    mu_x = popt[2],
-    mu_y = popt[3]
+    mu_x = popt[2] * bin_factor + (bin_factor - 1) / 2,
+    mu_y = popt[3] * bin_factor + (bin_factor - 1) / 2
     file_name = basename(matrix.get_path())
     save_path = splitext(matrix.get_path())[0] + ".md"
 
@@ -94,8 +270,22 @@ def write_gaussian_fit_info_md(result,
            f"* Background: {background}\n" \
            f"* Centroid (X, Y): ({mu_x}, {mu_y})\n" \
            f"\n" \
+           f"### Fit Resolution\n" \
+           f"The Gaussian was fitted on {fit_info['fit_pixels']} of " \
+           f"{fit_info['total_pixels']} pixels in " \
+           f"{fit_info['fit_time']:.2f} s. Larger binning factors and fewer " \
+           f"refinement samples are faster, the relative RMS residual of " \
+           f"the fit to the full resolution shading reference shows the " \
+           f"accuracy.\n" \
+           f"* Binning factor: {fit_info['bin_factor']}\n" \
+           f"* Refinement samples: {fit_info['n_samples']}\n" \
+           f"* Relative RMS residual: " \
+           f"{fit_info['relative_rms_residual']:.5f}\n" \
+           f"\n" \
            f"## Parameters\n" \
            f"* `shading_reference`: {shading_reference}\n" \
+           f"* `bin_factor`: {fit_info['bin_factor']}\n" \
+           f"* `n_samples`: {fit_info['n_samples']}\n" \
            f"\n" \
            f"## Packages\n" \
            f"* [https://github.com/fmi-faim/eicm](" \
@@ -144,10 +334,14 @@ def write_gaussian_fit_info_md(result,
 )
 def eicm_gaussian_fit(
         shading_references: List[Path] = [Path("/path/to/shading_reference")],
+        bin_factor: int = 1,
+        n_samples: int = 0,
 ):
     for shading_reference in shading_references:
         future = estimate_correction_matrix.submit(
-            shading_reference=shading_reference)
+            shading_reference=shading_reference,
+            bin_factor=bin_factor,
+            n_samples=n_samples)
 
         write_gaussian_fit_info_md.submit(result=future,
                                           name=get_run_context().flow.name,
@@ -15,18 +15,16 @@ from prefect import task, flow
 from prefect.context import get_run_context
 from prefect_dask import DaskTaskRunner
 
-from eicm_flows.fit_gaussian_estimation import load_tiff
+from eicm_flows.fit_gaussian_estimation import load_tiff, \
+    reference_content_hash
 
 
-@task(cache_key_fn=task_input_hash)
-def fit_polynomial(shading_reference: Path, polynomial_degree: int,
-                                       order: int):
-
+def polynomial_fit_matrix(shading_reference: Path, resolution, metadata,
+                          data: np.ndarray, polynomial_degree: int,
+                          order: int):
     n, ext = splitext(basename(shading_reference))
     save_path = join(dirname(shading_reference), f"{n}_poly-fit{ext}")
 
-    resolution, metadata, data = load_tiff(path=shading_reference)
-
     matrix = ImageTarget.from_path(save_path,
                                    metadata=metadata,
                                    resolution=resolution)
@@ -35,11 +33,24 @@ def fit_polynomial(shading_reference: Path, polynomial_degree: int,
                                    polynomial_degree=polynomial_degree,
                                    order=order)
 
-    matrix.set_data(normalize_matrix(fit).astype(np.float32))
+    matrix.set_data(normalize_matrix(fit.astype(np.float32, copy=False)))
 
     return matrix
 
 
+@task(cache_key_fn=reference_content_hash)
+def fit_polynomial(shading_reference: Path, polynomial_degree: int,
+                                       order: int):
+    resolution, metadata, data = load_tiff(path=shading_reference)
+
+    return polynomial_fit_matrix(shading_reference=shading_reference,
+                                 resolution=resolution,
+                                 metadata=metadata,
+                                 data=data,
+                                 polynomial_degree=polynomial_degree,
+                                 order=order)
+
+
 @task(cache_key_fn=task_input_hash)
 def write_poly_fit_info_md(matrix: ImageTarget,
                            name: str,
@@ -1,7 +1,7 @@
 from datetime import datetime
 from os.path import splitext, join, basename, dirname
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Literal
 
 import numpy as np
 import pkg_resources
@@ -13,36 +13,91 @@ from faim_prefect.prefect import get_prefect_context
 from prefect import task, flow
 from prefect.context import get_run_context
 from prefect_dask import DaskTaskRunner
-from scipy.ndimage import median_filter
+from scipy.ndimage import median_filter, zoom
 
-from eicm_flows.fit_gaussian_estimation import load_tiff
+from eicm_flows.fit_gaussian_estimation import load_tiff, \
+    reference_content_hash
 
 
-@task(cache_key_fn=task_input_hash)
-def median_filter_task(shading_reference: Path, filter_size: int = 3):
+MedianFilterMethods = Literal[
+    "exact",
+    "downsampled",
+]
+
+
+def downsampled_median_filter(data: np.ndarray, filter_size: int,
+                              target_size: int = 9):
+    """Approximate median filter for large filter sizes.
+
+    The image is block-averaged such that the filter shrinks to about
+    `target_size` pixels, median filtered and linearly upsampled again.
+    """
+    factor = max(1, filter_size // target_size)
+    if factor == 1:
+        return median_filter(data, size=filter_size)
+
+    height, width = data.shape
+    padded = np.pad(data, ((0, -height % factor), (0, -width % factor)),
+                    mode="edge")
+    binned = padded.reshape(padded.shape[0] // factor, factor,
+                            padded.shape[1] // factor, factor).mean(
+        axis=(1, 3))
+
+    filtered = median_filter(binned,
+                             size=max(1, round(filter_size / factor)))
+
+    upsampled = zoom(filtered, factor, order=1, mode="nearest",
+                     grid_mode=True)
+    return upsampled[:height, :width]
+
+
+def filter_median(data: np.ndarray, filter_size: int,
+                  method: MedianFilterMethods = "exact"):
+    if method == "downsampled":
+        return downsampled_median_filter(data, filter_size=filter_size)
+
+    return median_filter(data, size=filter_size)
+
+
+def median_filter_matrix(shading_reference: Path, resolution, metadata,
+                         data: np.ndarray, filter_size: int = 3,
+                         method: MedianFilterMethods = "exact"):
     n, ext = splitext(basename(shading_reference))
     save_path = join(dirname(shading_reference),
                      f"{n}_median-filtered{ext}")
 
-    resolution, metadata, data = load_tiff(path=shading_reference)
-
     matrix = ImageTarget.from_path(save_path,
                                    metadata=metadata,
                                    resolution=resolution)
 
-    matrix.set_data(normalize_matrix(median_filter(data,
-                                                   size=filter_size)).astype(
+    matrix.set_data(normalize_matrix(filter_median(data,
+                                                   filter_size=filter_size,
+                                                   method=method)).astype(
         np.float32))
 
     return matrix
 
 
+@task(cache_key_fn=reference_content_hash)
+def median_filter_task(shading_reference: Path, filter_size: int = 3,
+                       method: MedianFilterMethods = "exact"):
+    resolution, metadata, data = load_tiff(path=shading_reference)
+
+    return median_filter_matrix(shading_reference=shading_reference,
+                                resolution=resolution,
+                                metadata=metadata,
+                                data=data,
+                                filter_size=filter_size,
+                                method=method)
+
+
 @task(cache_key_fn=task_input_hash)
 def write_median_filter_info_md(matrix: ImageTarget,
                                 name: str,
                                 shading_reference: Path,
                                 filter_size: int,
-                                context: Dict):
+                                context: Dict,
+                                method: MedianFilterMethods = "exact"):
     date = datetime.now().strftime("%Y/%m/%d, %H:%M:%S")
     eicm_version = pkg_resources.get_distribution("eicm").version
     flow_repo = "https://github.com/fmi-faim/prefect-workflows/blob/main/eicm_flows"
@@ -65,6 +120,7 @@ def write_median_filter_info_md(matrix: ImageTarget,
            f"## Parameters\n" \
            f"* `shading_reference`: {shading_reference}\n" \
            f"* `filter_size`: {filter_size}\n" \
+           f"* `method`: {method}\n" \
            f"\n" \
            f"## Packages\n" \
            f"* [https://github.com/fmi-faim/eicm](" \
@@ -114,17 +170,20 @@ def write_median_filter_info_md(matrix: ImageTarget,
 def eicm_median_filter(
         shading_references: List[Path] = [Path("/path/to/shading_reference")],
         filter_size: int = 3,
+        method: MedianFilterMethods = "exact",
 ):
     for shading_reference in shading_references:
         matrix = median_filter_task.submit(
             shading_reference=shading_reference,
-            filter_size=filter_size)
+            filter_size=filter_size,
+            method=method)
 
         write_median_filter_info_md.submit(matrix=matrix,
                                            name=get_run_context().flow.name,
                                            shading_reference=shading_reference,
                                            filter_size=filter_size,
                                            context=get_prefect_context(
-                                               get_run_context())
+                                               get_run_context()),
+                                           method=method
                                            )
 
@@ -1,13 +1,21 @@
 from pathlib import Path
-from typing import List
+from typing import List, Dict
 
-from prefect import flow
+from cpr.Serializer import cpr_serializer
+from faim_prefect.prefect import get_prefect_context
+from prefect import flow, task
+from prefect.context import get_run_context
 from prefect_dask import DaskTaskRunner
 from pydantic import BaseModel
 
-from eicm_flows.fit_gaussian_estimation import eicm_gaussian_fit
-from eicm_flows.fit_polynomial_estimation import eicm_polynomial_fit
-from eicm_flows.median_filter_estimation import eicm_median_filter
+from eicm_flows.fit_gaussian_estimation import eicm_gaussian_fit, \
+    load_tiff, gaussian_fit_matrix, write_gaussian_fit_info_md, \
+    reference_content_hash
+from eicm_flows.fit_polynomial_estimation import eicm_polynomial_fit, \
+    polynomial_fit_matrix, write_poly_fit_info_md
+from eicm_flows.median_filter_estimation import eicm_median_filter, \
+    median_filter_matrix, write_median_filter_info_md, \
+    MedianFilterMethods
 
 
 class RawData(BaseModel):
@@ -19,10 +27,13 @@ class RawData(BaseModel):
 class MedianFilter(BaseModel):
     apply: bool = True
     filter_size: int = 3
+    method: MedianFilterMethods = "exact"
 
 
 class GaussianFit(BaseModel):
     apply: bool = True
+    bin_factor: int = 1
+    n_samples: int = 0
 
 
 class PolynomialFit(BaseModel):
@@ -31,10 +42,92 @@ class PolynomialFit(BaseModel):
     order: int = 4
 
 
+@task(cache_key_fn=reference_content_hash)
+def estimate_correction_matrices(shading_reference: Path,
+                                 median_filter: MedianFilter,
+                                 gaussian_fit: GaussianFit,
+                                 polynomial_fit: PolynomialFit,
+                                 name: str,
+                                 context: Dict):
+    """Runs all requested estimators on a single read of the reference.
+
+    The reference is memory-mapped read-only, the estimators do not modify
+    it.
+    """
+    resolution, metadata, data = load_tiff(path=shading_reference, mmap=True)
+
+    matrices = []
+    if median_filter.apply:
+        matrix = median_filter_matrix(shading_reference=shading_reference,
+                                      resolution=resolution,
+                                      metadata=metadata,
+                                      data=data,
+                                      filter_size=median_filter.filter_size,
+                                      method=median_filter.method)
+        write_median_filter_info_md.fn(matrix=matrix,
+                                       name=name,
+                                       shading_reference=shading_reference,
+                                       filter_size=median_filter.filter_size,
+                                       context=context,
+                                       method=median_filter.method)
+        matrices.append(matrix)
+
+    if gaussian_fit.apply:
+        result = gaussian_fit_matrix(shading_reference=shading_reference,
+                                     resolution=resolution,
+                                     metadata=metadata,
+                                     data=data,
+                                     bin_factor=gaussian_fit.bin_factor,
+                                     n_samples=gaussian_fit.n_samples)
+        write_gaussian_fit_info_md.fn(result=result,
+                                      name=name,
+                                      shading_reference=shading_reference,
+                                      context=context)
+        matrices.append(result[0])
+
+    if polynomial_fit.apply:
+        matrix = polynomial_fit_matrix(
+            shading_reference=shading_reference,
+            resolution=resolution,
+            metadata=metadata,
+            data=data,
+            polynomial_degree=polynomial_fit.polynomial_degree,
+            order=polynomial_fit.order)
+        write_poly_fit_info_md.fn(
+            matrix=matrix,
+            name=name,
+            shading_reference=shading_reference,
+            polynomial_degree=polynomial_fit.polynomial_degree,
+            order=polynomial_fit.order,
+            context=context)
+        matrices.append(matrix)
+
+    return tuple(matrices)
+
+
+def submit_fused_estimations(shading_references: List[Path],
+                             median_filter: MedianFilter,
+                             gaussian_fit: GaussianFit,
+                             polynomial_fit: PolynomialFit):
+    run_context = get_run_context()
+    context = get_prefect_context(run_context)
+    return [
+        estimate_correction_matrices.submit(
+            shading_reference=shading_reference,
+            median_filter=median_filter,
+            gaussian_fit=gaussian_fit,
+            polynomial_fit=polynomial_fit,
+            name=run_context.flow.name,
+            context=context)
+        for shading_reference in shading_references
+    ]
+
+
 @flow(
     name="EICM All",
     cache_result_in_memory=False,
     persist_result=True,
+    result_serializer=cpr_serializer(),
     result_storage="local-file-system/eicm",
     task_runner=DaskTaskRunner(
         cluster_class="dask_jobqueue.SLURMCluster",
@@ -69,14 +162,28 @@ def eicm_all(
         raw_data: RawData = RawData(),
         median_filter: MedianFilter = MedianFilter(),
         gaussian_fit: GaussianFit = GaussianFit(),
-        polynomial_fit: PolynomialFit = PolynomialFit()
+        polynomial_fit: PolynomialFit = PolynomialFit(),
+        fused: bool = False,
 ):
+    if fused:
+        # Load every reference once and run all estimators on the cluster
+        # of this flow instead of starting one cluster per estimator.
+        submit_fused_estimations(
+            shading_references=raw_data.shading_references,
+            median_filter=median_filter,
+            gaussian_fit=gaussian_fit,
+            polynomial_fit=polynomial_fit)
+        return
+
     if median_filter.apply:
         eicm_median_filter(shading_references=raw_data.shading_references,
-                           filter_size=median_filter.filter_size)
+                           filter_size=median_filter.filter_size,
+                           method=median_filter.method)
 
     if gaussian_fit.apply:
-        eicm_gaussian_fit(shading_references=raw_data.shading_references)
+        eicm_gaussian_fit(shading_references=raw_data.shading_references,
+                          bin_factor=gaussian_fit.bin_factor,
+                          n_samples=gaussian_fit.n_samples)
 
     if polynomial_fit.apply:
         eicm_polynomial_fit(shading_references=raw_data.shading_references,
@@ -1,12 +1,17 @@
+import hashlib
 import os
+import pickle
+import sqlite3
+from contextlib import closing
 from datetime import datetime
 from enum import Enum
-from glob import glob
 from os.path import basename, join, splitext
 from pathlib import Path
-from typing import Literal, Tuple, Dict
+from tempfile import TemporaryDirectory
+from typing import Literal, Tuple, Dict, List, Optional
 
 import numpy as np
+import pandas as pd
 from cpr.Serializer import cpr_serializer
 from cpr.image.ImageTarget import ImageTarget
 from cpr.utilities.utilities import task_input_hash
@@ -15,62 +20,318 @@ from eicm.preprocessing.yokogawa import get_metadata, create_table, \
     compute_median_projection, get_output_name
 from faim_prefect.block.choices import Choices
 from faim_prefect.prefect import get_prefect_context
-from prefect import flow, task, get_run_logger
+from prefect import flow, task, get_run_logger, unmapped
 from prefect.context import get_run_context
 from prefect.filesystems import LocalFileSystem
 import pkg_resources
 from prefect_dask import DaskTaskRunner
+from tifffile import imread
 
 Microscopes = Literal[
     "CV7000",
     "CV8000"
 ]
 
+# Columns of the file table of `create_table`.
+CHANNEL_COLUMN = "channel"
+Z_COLUMN = "Z"
+PATH_COLUMN = "path"
 
-@task(cache_key_fn=task_input_hash)
-def create_shading_reference(input_dir: Path, z_plane: int, output_dir: Path):
-
-    acq_date, px_size, px_unit, channels = get_metadata(input_dir=input_dir)
-    plate_name = basename(input_dir)
-
-    files = glob(join(input_dir, plate_name + "*.tif"))
-    table = create_table(files=files, plate_name=plate_name)
 
+def compute_median_projections(table: pd.DataFrame,
+                               z_plane: int,
+                               channel_metadata: Dict,
+                               input_dir: Path):
     channel_stacks = build_field_stacks_for_channels(table=table,
                                                      z_plane=z_plane)
 
     dark_img_subtracted = subtract_dark_images(stacks=channel_stacks,
-                                               channel_metadata=channels,
+                                               channel_metadata=channel_metadata,
                                                input_dir=input_dir)
 
-    projections = compute_median_projection(stacks=dark_img_subtracted)
-
-    references = []
-    for ch, projection in projections.items():
-        out_name = get_output_name(acquistion_date=acq_date,
-                                   channel=channels[str(int(ch[1:]))])
-        final_out_dir = join(output_dir, acq_date)
-        os.makedirs(final_out_dir, exist_ok=True)
-        out_img = ImageTarget.from_path(join(final_out_dir, out_name),
-                                        resolution=[1e4 / px_size,
-                                                    1e4 / px_size],
-                                        metadata={"axes": "YX",
-                                                  "PhysicalSizeX": px_size,
-                                                  "PhysicalSizeXUnit": px_unit,
-                                                  "PhysicalSizeY": px_size,
-                                                  "PhysicalSizeYUnit": px_unit,}
-                                        )
-        out_img.set_data(projection.astype(np.float32))
-        references.append(out_img)
-
-    return tuple(references)
+    return compute_median_projection(stacks=dark_img_subtracted)
+
+
+def channel_key(channel) -> str:
+    """Channel of the file table as key of the stacks, e.g. "C01"."""
+    channel = str(channel)
+    return channel if channel.startswith("C") else f"C{int(channel):02d}"
+
+
+def spill_fields(table: pd.DataFrame, z_plane: int, tmp_dir: str):
+    """Fields of the z-plane per channel as temporary memory-maps.
+
+    The table is filtered by z-plane and grouped by channel once, then the
+    fields are loaded one at a time.
+    """
+    table = table[table[Z_COLUMN].astype(int) == z_plane]
+    fields = {}
+    for channel, ch_table in table.groupby(CHANNEL_COLUMN, sort=True):
+        ch = channel_key(channel)
+        for i, path in enumerate(sorted(ch_table[PATH_COLUMN])):
+            img = imread(path)
+            field = np.lib.format.open_memmap(join(tmp_dir, f"{ch}-{i}.npy"),
+                                              mode="w+", dtype=img.dtype,
+                                              shape=img.shape)
+            field[:] = img
+            field.flush()
+            fields.setdefault(ch, []).append(field)
+
+    return fields
+
+
+def load_dark_image(channel: str,
+                    shape: Tuple[int, int],
+                    dtype: np.dtype,
+                    channel_metadata: Dict,
+                    input_dir: Path) -> np.ndarray:
+    """Dark image of a channel as subtracted by `subtract_dark_images`.
+
+    eicm does not expose the dark image itself. It is recovered by
+    subtracting it from a saturated image, where nothing is clipped.
+    """
+    saturated = np.full((1, *shape), np.iinfo(dtype).max, dtype=dtype)
+    subtracted = subtract_dark_images(stacks={channel: saturated},
+                                      channel_metadata=channel_metadata,
+                                      input_dir=input_dir)[channel][0]
+    return saturated[0].astype(np.int32) - subtracted.astype(np.int32)
+
+
+def streaming_median_projection(channel: str,
+                                fields: List[np.ndarray],
+                                dark: np.ndarray,
+                                max_memory_mb: float) -> np.ndarray:
+    """Median projection of the dark-image subtracted fields in row-bands.
+
+    Only one row-band of all fields is held in memory at a time. The dark
+    image is subtracted from every band with the uint16 clipping of
+    `subtract_dark_images`. The band height is chosen such that the band
+    stack, the subtraction and the working copy of `np.median` stay below
+    `max_memory_mb`, independent of the number of fields.
+    """
+    height, width = fields[0].shape
+    itemsize = fields[0].itemsize
+    bytes_per_row = len(fields) * width * (3 * itemsize + 4) + 8 * width
+    band_height = int(max_memory_mb * 2 ** 20 // bytes_per_row)
+    if band_height < 1:
+        raise ValueError(f"max_memory_mb={max_memory_mb} is below a single "
+                         f"row of {len(fields)} fields "
+                         f"({bytes_per_row / 2 ** 20:.3f} MB).")
+
+    projection = None
+    for start in range(0, height, min(band_height, height)):
+        stop = min(start + band_height, height)
+        band = np.stack([field[start:stop] for field in fields])
+        band = np.clip(band.astype(np.int32) - dark[start:stop], 0,
+                       None).astype(band.dtype)
+        median = compute_median_projection(stacks={channel: band})[channel]
+        if projection is None:
+            projection = np.empty((height, width), dtype=median.dtype)
+
+        projection[start:stop] = median
+
+    return projection
+
+
+def check_max_memory_mb(max_memory_mb: float):
+    if not max_memory_mb > 0:
+        raise ValueError(f"max_memory_mb must be positive, got "
+                         f"{max_memory_mb}.")
+
+
+def compute_streaming_median_projections(table: pd.DataFrame,
+                                         z_plane: int,
+                                         channel_metadata: Dict,
+                                         input_dir: Path,
+                                         max_memory_mb: float):
+    """Same result as `compute_median_projections` in bounded memory.
+
+    The dark image is loaded once per channel and subtracted per row-band.
+    """
+    check_max_memory_mb(max_memory_mb)
+    with TemporaryDirectory() as tmp_dir:
+        fields = spill_fields(table=table, z_plane=z_plane, tmp_dir=tmp_dir)
+        projections = {}
+        for ch, ch_fields in fields.items():
+            dark = load_dark_image(channel=ch,
+                                   shape=ch_fields[0].shape,
+                                   dtype=ch_fields[0].dtype,
+                                   channel_metadata=channel_metadata,
+                                   input_dir=input_dir)
+            projections[ch] = streaming_median_projection(
+                channel=ch,
+                fields=ch_fields,
+                dark=dark,
+                max_memory_mb=max_memory_mb)
+        del fields
+
+    return projections
+
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value BLOB);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime INTEGER);
+"""
+
+# Index table with the rows of `create_table` for all indexed files.
+FILE_TABLE = "file_table"
+
+
+def get_index_path(input_dir: Path, index_dir: str) -> str:
+    dir_hash = hashlib.sha1(str(input_dir).encode()).hexdigest()[:8]
+    return join(index_dir, f"{basename(input_dir)}-{dir_hash}.sqlite")
+
+
+def scan_field_files(input_dir: Path) -> Dict[str, int]:
+    """Modification times of the field images of an acquisition."""
+    plate_name = basename(input_dir)
+    files = {}
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith(plate_name) and \
+                    entry.name.endswith(".tif") and entry.is_file():
+                files[entry.path] = entry.stat().st_mtime_ns
+
+    return files
+
+
+def get_index_key(input_dir: Path, files: Dict[str, int]) -> str:
+    """Changes if a file is added, removed or rewritten.
+
+    The directory modification time alone misses files which are rewritten
+    in place and is coarse on some network file systems.
+    """
+    return f"{os.stat(input_dir).st_mtime_ns}-{len(files)}-" \
+           f"{max(files.values(), default=0)}"
+
+
+def has_file_table(con: sqlite3.Connection) -> bool:
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                       "AND name = ?", (FILE_TABLE,)).fetchone() is not None
+
+
+def update_file_table(con: sqlite3.Connection, files: Dict[str, int],
+                      plate_name: str):
+    """Remove the rows of removed or rewritten files and add the new ones.
+
+    Only the new files are parsed with `create_table`. The rows are stored
+    with their columns, such that they are read back without unpickling.
+    """
+    indexed = dict(con.execute("SELECT path, mtime FROM files"))
+    stale = [(path,) for path, mtime in indexed.items()
+             if files.get(path) != mtime]
+    new = sorted(path for path, mtime in files.items()
+                 if indexed.get(path) != mtime)
+
+    con.executemany("DELETE FROM files WHERE path = ?", stale)
+    if has_file_table(con):
+        con.executemany(f"DELETE FROM {FILE_TABLE} "
+                        f"WHERE {PATH_COLUMN} = ?", stale)
+
+    if len(new) > 0:
+        con.executemany("INSERT INTO files VALUES (?, ?)",
+                        [(path, files[path]) for path in new])
+        table = create_table(files=new, plate_name=plate_name)
+        table.to_sql(FILE_TABLE, con, if_exists="append", index=False)
+
+
+def load_acquisition(con: sqlite3.Connection, input_dir: Path):
+    """Metadata of an acquisition, the file table is updated if needed.
+
+    The acquisition is only parsed again if the index key of
+    `get_index_key` changed.
+    """
+    files = scan_field_files(input_dir=input_dir)
+    key = get_index_key(input_dir=input_dir, files=files)
+    state = dict(con.execute("SELECT key, value FROM state"))
+
+    if state.get("index_key") == key:
+        return pickle.loads(state["acquisition"])
+
+    update_file_table(con=con, files=files, plate_name=basename(input_dir))
+    acquisition = get_metadata(input_dir=input_dir)
+    con.executemany("REPLACE INTO state VALUES (?, ?)",
+                    [("index_key", key),
+                     ("acquisition", pickle.dumps(acquisition))])
+
+    return acquisition
+
+
+def load_channel_tables(con: sqlite3.Connection) -> Dict[str, pd.DataFrame]:
+    """File tables per channel, grouped by the channel of `create_table`."""
+    if not has_file_table(con):
+        return {}
+
+    table = pd.read_sql(f"SELECT * FROM {FILE_TABLE} ORDER BY {PATH_COLUMN}",
+                        con)
+    return {channel_key(channel): ch_table.reset_index(drop=True)
+            for channel, ch_table in table.groupby(CHANNEL_COLUMN, sort=True)}
+
+
+@task()
+def list_channel_files(input_dir: Path, index_dir: str):
+    os.makedirs(index_dir, exist_ok=True)
+    index_path = get_index_path(input_dir=input_dir, index_dir=index_dir)
+
+    with closing(sqlite3.connect(index_path)) as con, con:
+        con.executescript(INDEX_SCHEMA)
+        acquisition = load_acquisition(con=con, input_dir=input_dir)
+        tables = load_channel_tables(con=con)
+
+    channel_files = {ch: list(table[PATH_COLUMN])
+                     for ch, table in tables.items()}
+    return acquisition, channel_files, tables
+
+
+@task(cache_key_fn=task_input_hash)
+def create_shading_reference(input_dir: Path, channel: str, files: List[str],
+                             acquisition: Tuple, z_plane: int,
+                             output_dir: Path, streaming: bool = False,
+                             max_memory_mb: float = 1024,
+                             table: Optional[pd.DataFrame] = None):
+    acq_date, px_size, px_unit, channels = acquisition
+
+    if table is None:
+        table = create_table(files=files, plate_name=basename(input_dir))
+
+    if streaming:
+        projections = compute_streaming_median_projections(
+            table=table,
+            z_plane=z_plane,
+            channel_metadata=channels,
+            input_dir=input_dir,
+            max_memory_mb=max_memory_mb
+        )
+    else:
+        projections = compute_median_projections(table=table,
+                                                 z_plane=z_plane,
+                                                 channel_metadata=channels,
+                                                 input_dir=input_dir)
+
+    out_name = get_output_name(acquistion_date=acq_date,
+                               channel=channels[str(int(channel[1:]))])
+    final_out_dir = join(output_dir, acq_date)
+    os.makedirs(final_out_dir, exist_ok=True)
+    out_img = ImageTarget.from_path(join(final_out_dir, out_name),
+                                    resolution=[1e4 / px_size,
+                                                1e4 / px_size],
+                                    metadata={"axes": "YX",
+                                              "PhysicalSizeX": px_size,
+                                              "PhysicalSizeXUnit": px_unit,
+                                              "PhysicalSizeY": px_size,
+                                              "PhysicalSizeYUnit": px_unit,}
+                                    )
+    out_img.set_data(projections[channel].astype(np.float32))
+
+    return out_img
 
 
 @task(cache_key_fn=task_input_hash)
 def write_info_md(references: Tuple[ImageTarget],
                   name: str,
                   input_dir: Path, z_plane: int, microscope: str, group: str,
-                  output_dir: Path, context: Dict):
+                  output_dir: Path, streaming: bool, max_memory_mb: float,
+                  context: Dict):
     date = datetime.now().strftime("%Y/%m/%d, %H:%M:%S")
     eicm_version = pkg_resources.get_distribution("eicm").version
     flow_repo = "https://github.com/fmi-faim/prefect-workflows/blob/main/eicm_flows"
@@ -98,6 +359,8 @@ def write_info_md(references: Tuple[ImageTarget],
                f"* `z_plane`: {z_plane}\n" \
                f"* `group`: {group}\n" \
                f"* `output_dir`: {output_dir}\n" \
+               f"* `streaming`: {streaming}\n" \
+               f"* `max_memory_mb`: {max_memory_mb}\n" \
                f"\n" \
                f"## Packages\n" \
                f"* [https://github.com/fmi-faim/eicm](" \
@@ -109,6 +372,51 @@ def write_info_md(references: Tuple[ImageTarget],
         with open(save_path, "w") as f:
             f.write(text)
 
+
+def compute_shading_references(input_dir: Path,
+                               microscope: str,
+                               z_plane: int,
+                               group: Enum,
+                               output_dir: Path,
+                               streaming: bool = False,
+                               max_memory_mb: float = 1024):
+    """Submit the shading reference tasks to the task runner of the caller.
+
+    Returns the paths of the shading references.
+    """
+    output_dir_ = join(output_dir, group.value, microscope, "Maintenance",
+                      "Shading_Reference")
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    acquisition, channel_files, tables = list_channel_files(
+        input_dir=input_dir,
+        index_dir=join(output_dir_, ".index"))
+
+    # One task per channel, such that the channels are processed
+    # concurrently on the cluster.
+    references = create_shading_reference.map(
+        input_dir=unmapped(input_dir),
+        channel=list(channel_files.keys()),
+        files=list(channel_files.values()),
+        acquisition=unmapped(acquisition),
+        z_plane=unmapped(z_plane),
+        output_dir=unmapped(output_dir_),
+        streaming=unmapped(streaming),
+        max_memory_mb=unmapped(max_memory_mb),
+        table=[tables.get(ch) for ch in channel_files.keys()])
+
+    context = get_prefect_context(get_run_context())
+    write_info_md.submit(references, name=get_run_context().flow.name,
+                         input_dir=input_dir, z_plane=z_plane,
+                         microscope=microscope, group=group.value,
+                         output_dir=output_dir, streaming=streaming,
+                         max_memory_mb=max_memory_mb, context=context)
+
+    reference_paths = [ref.result().get_path() for ref in references]
+    return reference_paths
+
+
 GROUPS = Choices.load("fmi-groups").get()
 
 @flow(name="Create Shading Reference [Yokogawa]",
@@ -151,22 +459,13 @@ def create_shading_reference_yokogawa(input_dir: Path =
                                       group: GROUPS = GROUPS.gmicro,
                                       output_dir: Path =
                                       Path(LocalFileSystem.load(
-                                          "tungsten-gmicro-hcs").basepath)):
-    output_dir_ = join(output_dir, group.value, microscope, "Maintenance",
-                      "Shading_Reference")
-
-    os.makedirs(output_dir, exist_ok=True)
-
-    references = create_shading_reference.submit(
-        input_dir=input_dir,
-        z_plane=z_plane,
-        output_dir=output_dir_)
-
-    context = get_prefect_context(get_run_context())
-    write_info_md.submit(references, name=get_run_context().flow.name,
-                         input_dir=input_dir, z_plane=z_plane,
-                         microscope=microscope, group=group.value,
-                         output_dir=output_dir, context=context)
-
-    reference_paths = [ref.get_path() for ref in references.result()]
-    return reference_paths
+                                          "tungsten-gmicro-hcs").basepath),
+                                      streaming: bool = False,
+                                      max_memory_mb: float = 1024):
+    return compute_shading_references(input_dir=input_dir,
+                                      microscope=microscope,
+                                      z_plane=z_plane,
+                                      group=group,
+                                      output_dir=output_dir,
+                                      streaming=streaming,
+                                      max_memory_mb=max_memory_mb)
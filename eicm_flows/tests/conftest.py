@@ -0,0 +1,17 @@
+import importlib
+from enum import Enum
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+
+def import_flow_module(name: str):
+    """Import a flow module without loading Prefect blocks from the server."""
+    pytest.importorskip("eicm")
+    groups = Enum("Groups", {"gmicro": "gmicro"})
+    with patch("faim_prefect.block.choices.Choices.load",
+               return_value=SimpleNamespace(get=lambda: groups)), \
+            patch("prefect.filesystems.LocalFileSystem.load",
+                  return_value=SimpleNamespace(basepath="/tmp")):
+        return importlib.import_module(f"eicm_flows.{name}")
@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from tifffile import imwrite
+
+from eicm_flows.tests.conftest import import_flow_module
+
+
+@pytest.fixture(scope="module")
+def run_all_estimations():
+    return import_flow_module("run_all_estimations")
+
+
+@pytest.fixture
+def cache_key(run_all_estimations, tmp_path):
+    shading_reference = tmp_path / "shading_reference.tif"
+    imwrite(shading_reference, np.ones((16, 16), dtype=np.float32))
+    task = run_all_estimations.estimate_correction_matrices
+
+    def key(name, context):
+        return run_all_estimations.reference_content_hash(
+            SimpleNamespace(task=task),
+            {
+                "shading_reference": shading_reference,
+                "median_filter": run_all_estimations.MedianFilter(),
+                "gaussian_fit": run_all_estimations.GaussianFit(),
+                "polynomial_fit": run_all_estimations.PolynomialFit(),
+                "name": name,
+                "context": context,
+            })
+
+    return shading_reference, key
+
+
+def test_cache_key_ignores_run_context(cache_key):
+    _, key = cache_key
+    assert key("EICM All", {"flow_run_id": "run-1"}) == \
+           key("EICM Batch", {"flow_run_id": "run-2"})
+
+
+def test_cache_key_changes_with_content(cache_key):
+    shading_reference, key = cache_key
+    before = key("EICM All", {"flow_run_id": "run-1"})
+    imwrite(shading_reference, np.zeros((16, 16), dtype=np.float32))
+    assert key("EICM All", {"flow_run_id": "run-1"}) != before
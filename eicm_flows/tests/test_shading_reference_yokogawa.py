@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from tifffile import imwrite
+
+from eicm_flows.tests.conftest import import_flow_module
+
+PLATE_NAME = "plate"
+DARK_LEVEL = 100
+
+
+@pytest.fixture(scope="module")
+def yokogawa():
+    return import_flow_module("shading_reference_yokogawa")
+
+
+def subtract_dark_level(stacks, channel_metadata, input_dir):
+    # Same uint16 clipping as the dark-image subtraction of eicm.
+    return {ch: np.clip(stack.astype(np.int32) - DARK_LEVEL, 0,
+                        None).astype(np.uint16)
+            for ch, stack in stacks.items()}
+
+
+def write_fields(input_dir, n_fields=4, n_planes=2, shape=(64, 48)):
+    rng = np.random.default_rng(0)
+    files = []
+    for field in range(1, n_fields + 1):
+        for z in range(1, n_planes + 1):
+            path = input_dir / (f"{PLATE_NAME}_B03_T0001F{field:03d}L01A01"
+                                f"Z{z:02d}C01.tif")
+            # Values around the dark level and an even number of fields,
+            # such that the clipping does not commute with the median.
+            imwrite(path, rng.integers(0, 2 * DARK_LEVEL, shape,
+                                       dtype=np.uint16))
+            files.append(str(path))
+
+    return files
+
+
+def test_streaming_matches_in_memory(yokogawa, tmp_path, monkeypatch):
+    monkeypatch.setattr(yokogawa, "subtract_dark_images",
+                        subtract_dark_level)
+    files = write_fields(tmp_path)
+    table = yokogawa.create_table(files=files, plate_name=PLATE_NAME)
+
+    in_memory = yokogawa.compute_median_projections(table=table,
+                                                    z_plane=2,
+                                                    channel_metadata={},
+                                                    input_dir=tmp_path)
+    # A tiny memory budget forces several row-bands.
+    streaming = yokogawa.compute_streaming_median_projections(
+        table=table,
+        z_plane=2,
+        channel_metadata={},
+        input_dir=tmp_path,
+        max_memory_mb=0.01)
+
+    assert in_memory.keys() == streaming.keys()
+    for ch in in_memory:
+        np.testing.assert_array_equal(streaming[ch], in_memory[ch])
+
+
+@pytest.mark.parametrize("max_memory_mb", [0, -1, 1e-6])
+def test_streaming_rejects_too_small_memory(yokogawa, tmp_path, monkeypatch,
+                                            max_memory_mb):
+    monkeypatch.setattr(yokogawa, "subtract_dark_images",
+                        subtract_dark_level)
+    table = yokogawa.create_table(files=write_fields(tmp_path),
+                                  plate_name=PLATE_NAME)
+
+    with pytest.raises(ValueError, match="max_memory_mb"):
+        yokogawa.compute_streaming_median_projections(
+            table=table,
+            z_plane=2,
+            channel_metadata={},
+            input_dir=tmp_path,
+            max_memory_mb=max_memory_mb)
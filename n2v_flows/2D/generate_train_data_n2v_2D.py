@@ -1,9 +1,16 @@
 import json
 import random
+from glob import glob
 from os.path import join
 
+import numpy as np
 import prefect
 from n2v.internals.N2V_DataGenerator import N2V_DataGenerator
+from n2v_flows.image_io import get_axes, is_zarr, read_image, \
+    reorder_axes
+from n2v_flows.patches import plan_patches_task, \
+    crop_file_patches_task, save_patch_files_task, \
+    save_train_val_npy_task
 from n2v_tasks.prefect_task.environment_utils import \
     add_to_slurm_flow_run_table_task, save_slurm_job_info_task, \
     get_slurm_job_info_task, save_prefect_context_task, \
@@ -11,7 +18,7 @@ from n2v_tasks.prefect_task.environment_utils import \
 from n2v_tasks.prefect_task.generate_train_data import extract_patches_task, \
     save_train_val_data_task
 from n2v_tasks.prefect_task.path_utils import create_output_dir_task
-from prefect import task
+from prefect import task, case, unmapped
 from prefect.client import Secret
 from prefect.core import Flow, Parameter
 from prefect.executors import DaskExecutor
@@ -20,14 +27,26 @@ from prefect.storage import GitHub
 from prefect.tasks.secrets import PrefectSecret
 
 
+# Axes of the training images. OME-Zarr inputs are reordered to these axes.
+AXES = "YX"
+
+
 @task()
 def load_imgs_from_directory(data_dir: str,
                              filter: str):
     logger = prefect.context.get("logger")
-    datagen = N2V_DataGenerator()
-    imgs = datagen.load_imgs_from_directory(directory=data_dir,
-                                            filter=filter,
-                                            dims="YX")
+    if is_zarr(filter):
+        files = glob(join(data_dir, filter))
+        imgs = []
+        for f in files:
+            img, multiscales = read_image(f, AXES)
+            img = reorder_axes(img, get_axes(multiscales), AXES)
+            imgs.append(img.astype(np.float32)[np.newaxis, ..., np.newaxis])
+    else:
+        datagen = N2V_DataGenerator()
+        imgs = datagen.load_imgs_from_directory(directory=data_dir,
+                                                filter=filter,
+                                                dims=AXES)
     logger.info(f"Loaded {len(imgs)} images for N2V training.")
     if len(imgs) < 2:
         logger.error("At least two images are required for training.")
@@ -55,22 +74,52 @@ with Flow("N2V Data Generation [2D - 2D]",
     group = Parameter("group", default="gmicro")
     user = Parameter("user", default="buchtimo")
 
-    imgs = load_imgs_from_directory(data_dir=data_dir,
-                                    filter=filter)
-
-    X, X_val = extract_patches_task(imgs=imgs,
-                                    num_patches_per_img=num_patches_per_img,
-                                    patch_shape=patch_shape)
+    parallel = Parameter("parallel", default=False)
+    save_npy = Parameter("save_npy", default=False)
 
     output_dir = create_output_dir_task(save_data_path=save_data_path,
                                         group=group,
                                         user=user,
                                         name=name)
 
-    save_train_val_data_task(output_dir=output_dir,
-                             prefix=prefix,
-                             X=X,
-                             X_val=X_val)
+    with case(parallel, True):
+        work_items = plan_patches_task(
+            data_dir=data_dir,
+            filter=filter,
+            num_patches_per_img=num_patches_per_img,
+            patch_shape=patch_shape,
+            output_dir=output_dir,
+            prefix=prefix)
+        cropped = crop_file_patches_task.map(
+            work_item=work_items,
+            patch_shape=unmapped(patch_shape),
+            output_dir=unmapped(output_dir),
+            prefix=unmapped(prefix))
+        save_patch_files_task(cropped=cropped,
+                              output_dir=output_dir,
+                              prefix=prefix,
+                              save_npy=save_npy)
+
+    with case(parallel, False):
+        imgs = load_imgs_from_directory(data_dir=data_dir,
+                                        filter=filter)
+
+        X, X_val = extract_patches_task(
+            imgs=imgs,
+            num_patches_per_img=num_patches_per_img,
+            patch_shape=patch_shape)
+
+        with case(save_npy, True):
+            save_train_val_npy_task(output_dir=output_dir,
+                                    prefix=prefix,
+                                    X=X,
+                                    X_val=X_val)
+
+        with case(save_npy, False):
+            save_train_val_data_task(output_dir=output_dir,
+                                     prefix=prefix,
+                                     X=X,
+                                     X_val=X_val)
 
     save_conda_env_task(output_dir=output_dir)
     save_system_information_task(output_dir=output_dir)
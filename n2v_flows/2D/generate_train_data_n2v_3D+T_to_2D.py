@@ -5,6 +5,10 @@ from os.path import join
 
 import numpy as np
 import prefect
+from n2v_flows.image_io import get_axes, read_image, reorder_axes
+from n2v_flows.patches import sample_patches_task, \
+    plan_patches_task, crop_file_patches_task, save_patch_files_task, \
+    save_train_val_npy_task
 from n2v_tasks.prefect_task.environment_utils import save_conda_env_task, \
     save_system_information_task, get_prefect_context_task, \
     save_prefect_context_task, get_slurm_job_info_task, \
@@ -12,14 +16,16 @@ from n2v_tasks.prefect_task.environment_utils import save_conda_env_task, \
 from n2v_tasks.prefect_task.generate_train_data import extract_patches_task, \
     save_train_val_data_task
 from n2v_tasks.prefect_task.path_utils import create_output_dir_task
-from prefect import task
+from prefect import task, case, unmapped
 from prefect.client import Secret
 from prefect.core import Flow, Parameter
 from prefect.executors import DaskExecutor
 from prefect.run_configs import LocalRun
 from prefect.storage import GitHub
 from prefect.tasks.secrets import PrefectSecret
-from tifffile import imread
+
+# Axes of the TIFF inputs. OME-Zarr inputs are reordered to these axes.
+AXES = "TZYX"
 
 
 @task()
@@ -31,7 +37,9 @@ def load_imgs_from_directory(data_dir: str,
 
     imgs = []
     for f in files:
-        img = imread(f).astype(np.float32)
+        img, multiscales = read_image(f, AXES)
+        img = reorder_axes(img, get_axes(multiscales), AXES).astype(
+            np.float32)
         logger.info(f"Loaded {f} with shape = {img.shape}.")
         for t in img:
             for z in t:
@@ -59,23 +67,63 @@ with Flow("N2V Data Generation [3D+T - 2D]",
     prefix = Parameter("prefix", default="prefix")
     group = Parameter("group", default="gmicro")
     user = Parameter("user", default="buchtimo")
-
-    imgs = load_imgs_from_directory(data_dir=data_dir,
-                                    filter=filter)
-
-    X, X_val = extract_patches_task(imgs=imgs,
-                                    num_patches_per_img=num_patches_per_img,
-                                    patch_shape=patch_shape)
+    streaming = Parameter("streaming", default=False)
+    parallel = Parameter("parallel", default=False)
+    save_npy = Parameter("save_npy", default=False)
 
     output_dir = create_output_dir_task(save_data_path=save_data_path,
                                         group=group,
                                         user=user,
                                         name=name)
 
-    save_train_val_data_task(output_dir=output_dir,
-                             prefix=prefix,
-                             X=X,
-                             X_val=X_val)
+    with case(parallel, True):
+        work_items = plan_patches_task(
+            data_dir=data_dir,
+            filter=filter,
+            num_patches_per_img=num_patches_per_img,
+            patch_shape=patch_shape,
+            output_dir=output_dir,
+            prefix=prefix)
+        cropped = crop_file_patches_task.map(
+            work_item=work_items,
+            patch_shape=unmapped(patch_shape),
+            output_dir=unmapped(output_dir),
+            prefix=unmapped(prefix))
+        save_patch_files_task(cropped=cropped,
+                              output_dir=output_dir,
+                              prefix=prefix,
+                              save_npy=save_npy)
+
+    with case(parallel, False):
+        with case(streaming, True):
+            sample_patches_task(data_dir=data_dir,
+                                filter=filter,
+                                num_patches_per_img=num_patches_per_img,
+                                patch_shape=patch_shape,
+                                output_dir=output_dir,
+                                prefix=prefix,
+                                save_npy=save_npy)
+
+        with case(streaming, False):
+            imgs = load_imgs_from_directory(data_dir=data_dir,
+                                            filter=filter)
+
+            X, X_val = extract_patches_task(
+                imgs=imgs,
+                num_patches_per_img=num_patches_per_img,
+                patch_shape=patch_shape)
+
+            with case(save_npy, True):
+                save_train_val_npy_task(output_dir=output_dir,
+                                        prefix=prefix,
+                                        X=X,
+                                        X_val=X_val)
+
+            with case(save_npy, False):
+                save_train_val_data_task(output_dir=output_dir,
+                                         prefix=prefix,
+                                         X=X,
+                                         X_val=X_val)
 
     save_conda_env_task(output_dir=output_dir)
     save_system_information_task(output_dir=output_dir)
@@ -1,42 +1,26 @@
 import json
-from os.path import join, basename
+from os.path import join
 
-import numpy as np
-from csbdeep.io import save_tiff_imagej_compatible
+from n2v_flows.predict_tasks import shard_files_task, \
+    create_zarr_regions_task, predict_region, predict_files, \
+    save_performance_task
 from n2v_tasks.prefect_task.environment_utils import save_conda_env_task, \
     save_system_information_task, get_prefect_context_task, \
     save_prefect_context_task, get_slurm_job_info_task, \
     save_slurm_job_info_task, add_to_slurm_flow_run_table_task
 from n2v_tasks.prefect_task.path_utils import create_output_dir_task
-from n2v_tasks.prefect_task.predict import create_save_dir_task, \
-    load_model_task, get_files_task
-from n2v_tasks.task.predict import load_model
-from prefect import Flow, Parameter, task, unmapped
+from n2v_tasks.prefect_task.predict import create_save_dir_task, get_files_task
+from prefect import Flow, Parameter, unmapped
 from prefect.client import Secret
 from prefect.executors import DaskExecutor
 from prefect.run_configs import LocalRun
 from prefect.storage import GitHub
 from prefect.tasks.secrets import PrefectSecret
-from tifffile import imread
 
 
-@task(log_stdout=True)
-def predict(model_dir, model_name, file, n_tiles, save_dir):
-    model = load_model(model_dir=model_dir, model_name=model_name)
-    img = imread(file)
-    dtype = img.dtype
-    iinfo = np.iinfo(dtype)
-    pred = np.zeros_like(img)
+AXES = "TZYX"
 
-    for i, s in enumerate(img):
-        for j, z in enumerate(s):
-            z_pred = model.predict(z.astype(np.float32), axes="YX",
-                                   n_tiles=n_tiles)
-            pred[i, j] = np.clip(z_pred,
-                                 a_min=iinfo.min,
-                                 a_max=iinfo.max).astype(dtype)
-    save_tiff_imagej_compatible(join(save_dir, basename(file)), pred,
-                                axes="TZYX")
+MAX_GPU_WORKERS = 4
 
 
 with Flow("Predict 2D N2V [3D+T]",
@@ -51,6 +35,13 @@ with Flow("Predict 2D N2V [3D+T]",
     save_data_path = Parameter("save_data_path",
                                default="/path/to/save/results")
     n_tiles = Parameter("n_tiles", default=[1, 1])
+    n_shards = Parameter("n_shards", default=MAX_GPU_WORKERS)
+    prefetch = Parameter("prefetch", default=2)
+    output_format = Parameter("output_format", default="tif")
+    batch_size = Parameter("batch_size", default=None)
+    region_size = Parameter("region_size", default=8)
+    # Predict TIFF stacks batch by batch to TIFF or OME-Zarr, see README.
+    streaming = Parameter("streaming", default=False)
     group = Parameter("group", default="gmicro")
     user = Parameter("user", default="buchtimo")
     name = Parameter("name", default="run-name")
@@ -66,11 +57,37 @@ with Flow("Predict 2D N2V [3D+T]",
     save_dir = create_save_dir_task(output_dir=output_dir,
                                     model_name=model_name)
 
-    predict.map(model_dir=unmapped(model_dir),
-                model_name=unmapped(model_name),
-                file=files,
-                n_tiles=unmapped(n_tiles),
-                save_dir=unmapped(save_dir))
+    shards = shard_files_task(files=files,
+                              save_dir=save_dir,
+                              output_format=output_format,
+                              n_shards=n_shards,
+                              zarr_regions=True)
+
+    file_performance = predict_files.map(model_dir=unmapped(model_dir),
+                                         model_name=unmapped(model_name),
+                                         files=shards,
+                                         n_tiles=unmapped(n_tiles),
+                                         save_dir=unmapped(save_dir),
+                                         batch_size=unmapped(batch_size),
+                                         prefetch=unmapped(prefetch),
+                                         output_format=unmapped(output_format),
+                                         axes=unmapped(AXES),
+                                         streaming=unmapped(streaming))
+
+    regions = create_zarr_regions_task(files=files,
+                                       save_dir=save_dir,
+                                       output_format=output_format,
+                                       region_size=region_size)
+
+    region_performance = predict_region.map(model_dir=unmapped(model_dir),
+                                            model_name=unmapped(model_name),
+                                            region=regions,
+                                            n_tiles=unmapped(n_tiles),
+                                            batch_size=unmapped(batch_size))
+
+    save_performance_task(output_dir=output_dir,
+                          files=file_performance,
+                          regions=region_performance)
 
     save_conda_env_task(output_dir=output_dir)
     save_system_information_task(output_dir=output_dir)
@@ -99,9 +116,8 @@ slurm_config_path = join(Secret("prefect-slurm-configs").get(),
 with open(slurm_config_path, "r") as f:
     config = json.load(f)
 
-config["n_workers"] = 1
-
 flow.executor = DaskExecutor(
     cluster_class="dask_jobqueue.SLURMCluster",
-    cluster_kwargs=config
+    cluster_kwargs=config,
+    adapt_kwargs={"minimum": 1, "maximum": MAX_GPU_WORKERS},
 )
@@ -1,6 +1,11 @@
 import json
+import time
 from os.path import join
 
+import numpy as np
+from n2v_flows.monitoring import ResourceMonitor
+from n2v_flows.training import KnownStatsArray, channel_mean_std, \
+    open_memmapped_train_data, train_memmapped_model
 from n2v_tasks.prefect_task.environment_utils import \
     save_system_information_task, save_conda_env_task, \
     get_prefect_context_task, save_prefect_context_task, \
@@ -9,12 +14,100 @@ from n2v_tasks.prefect_task.environment_utils import \
 from n2v_tasks.prefect_task.path_utils import create_output_dir_task
 from n2v_tasks.prefect_task.train import build_model_task, \
     load_train_data_task, train_model_task
-from prefect import Flow, Parameter
+from prefect import Flow, Parameter, task, case
 from prefect.client import Secret
 from prefect.executors import DaskExecutor
 from prefect.run_configs import LocalRun
 from prefect.storage import GitHub
+from prefect.tasks.control_flow import merge
 from prefect.tasks.secrets import PrefectSecret
+from tensorflow.keras.callbacks import Callback
+
+
+class EpochTimer(Callback):
+    """Record the duration and the logs of every training epoch."""
+
+    def __init__(self):
+        super().__init__()
+        self.epochs = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epochs.append({
+            "epoch": epoch,
+            "duration_s": time.time() - self.epoch_start,
+            **{key: float(value) for key, value in (logs or {}).items()},
+        })
+
+
+@task()
+def is_npy_task(train_data: str):
+    return train_data.endswith(".npy")
+
+
+@task()
+def build_memmapped_model_task(output_dir: str,
+                               model_name: str,
+                               train_data: str,
+                               epochs: int,
+                               batch_size: int,
+                               group: str,
+                               user: str,
+                               name: str,
+                               wandb_project: str,
+                               wandb_entity: str):
+    """Build the model from memory-mapped `.npy` patches.
+
+    Only the path of the patches is passed between tasks. A memory map
+    returned by a task is pickled as a full in-memory array. The
+    normalization is computed chunk by chunk and handed to the `N2VConfig`
+    created by `build_model_task` through a `KnownStatsArray`.
+    """
+    X = np.load(train_data, mmap_mode="r")
+    mean, std = channel_mean_std(X)
+    return build_model_task.run(output_dir=output_dir,
+                                model_name=model_name,
+                                X=KnownStatsArray(X, mean=mean, std=std),
+                                epochs=epochs,
+                                batch_size=batch_size,
+                                group=group,
+                                user=user,
+                                name=name,
+                                wandb_project=wandb_project,
+                                wandb_entity=wandb_entity)
+
+
+@task(log_stdout=True)
+def train_instrumented_task(model, X, X_val, train_data, val_data, memmapped,
+                            prefetch, output_dir):
+    """Train the model while recording resource usage and epoch timings.
+
+    `.npy` patches are memory-mapped from `train_data` and `val_data` in
+    this task, otherwise the loaded `X` and `X_val` are used. The samples
+    of `ResourceMonitor` and the per-epoch durations are saved to
+    `performance.json` in the output directory.
+    """
+    if not model._model_prepared:
+        model.prepare_for_training()
+    epoch_timer = EpochTimer()
+    model.callbacks.append(epoch_timer)
+
+    with ResourceMonitor() as monitor:
+        if memmapped:
+            X, X_val = open_memmapped_train_data(train_data=train_data,
+                                                 val_data=val_data)
+            train_memmapped_model(model, X=X, X_val=X_val, prefetch=prefetch)
+        else:
+            train_model_task.run(model=model, X=X, X_val=X_val)
+
+    with open(join(output_dir, "performance.json"), "w") as f:
+        json.dump({"n_train": len(X),
+                   "n_val": len(X_val),
+                   "epochs": epoch_timer.epochs,
+                   **monitor.to_dict()}, f, indent=4)
+
 
 with Flow("Train N2V [2D]",
           run_config=LocalRun(labels=["SLURM"],
@@ -30,6 +123,7 @@ with Flow("Train N2V [2D]",
     save_data_path = Parameter("save_data_path", default="/path/to/save")
     epochs = Parameter("epochs", default=200)
     batch_size = Parameter("batch_size", default=128)
+    prefetch = Parameter("prefetch", default=4)
     group = Parameter("group", default="gmicro")
     user = Parameter("user", default="buchtimo")
     name = Parameter("name", default="run-name")
@@ -41,23 +135,44 @@ with Flow("Train N2V [2D]",
                                         user=user,
                                         name=name)
 
-    X, X_val = load_train_data_task(train_data=train_data,
-                                    val_data=val_data)
-
-    model = build_model_task(output_dir=output_dir,
-                             model_name=model_name,
-                             X=X,
-                             epochs=epochs,
-                             batch_size=batch_size,
-                             group=group,
-                             user=user,
-                             name=name,
-                             wandb_project=wandb_project,
-                             wandb_entity=wandb_entity)
-
-    train_model_task(model=model,
-                     X=X,
-                     X_val=X_val)
+    memmapped = is_npy_task(train_data=train_data)
+
+    with case(memmapped, True):
+        model_memmapped = build_memmapped_model_task(
+            output_dir=output_dir,
+            model_name=model_name,
+            train_data=train_data,
+            epochs=epochs,
+            batch_size=batch_size,
+            group=group,
+            user=user,
+            name=name,
+            wandb_project=wandb_project,
+            wandb_entity=wandb_entity)
+
+    with case(memmapped, False):
+        X, X_val = load_train_data_task(train_data=train_data,
+                                        val_data=val_data)
+
+        model_loaded = build_model_task(output_dir=output_dir,
+                                        model_name=model_name,
+                                        X=X,
+                                        epochs=epochs,
+                                        batch_size=batch_size,
+                                        group=group,
+                                        user=user,
+                                        name=name,
+                                        wandb_project=wandb_project,
+                                        wandb_entity=wandb_entity)
+
+    train_instrumented_task(model=merge(model_memmapped, model_loaded),
+                            X=merge(X),
+                            X_val=merge(X_val),
+                            train_data=train_data,
+                            val_data=val_data,
+                            memmapped=memmapped,
+                            prefetch=prefetch,
+                            output_dir=output_dir)
 
     save_conda_env_task(output_dir=output_dir)
     save_system_information_task(output_dir=output_dir)
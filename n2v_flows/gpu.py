@@ -0,0 +1,60 @@
+import os
+import subprocess
+
+
+def visible_gpu_ids():
+    """GPUs assigned to this process by `CUDA_VISIBLE_DEVICES`.
+
+    Returns None if the variable is not set, i.e. all GPUs are visible.
+    """
+    devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if devices is None:
+        return None
+    return [d.strip() for d in devices.split(",")
+            if d.strip() not in ("", "-1")]
+
+
+def nvidia_smi(query, fields):
+    """Run an nvidia-smi query restricted to the visible GPUs.
+
+    On shared SLURM nodes other jobs use the remaining GPUs of the node,
+    hence only the devices in `CUDA_VISIBLE_DEVICES` are queried.
+    Returns one dict per reported line, or an empty list if nvidia-smi is
+    not available.
+    """
+    ids = visible_gpu_ids()
+    if ids == []:
+        return []
+
+    cmd = ["nvidia-smi", f"--query-{query}={','.join(fields)}",
+           "--format=csv,noheader,nounits"]
+    if ids is not None:
+        cmd += ["-i", ",".join(ids)]
+    try:
+        out = subprocess.run(cmd, capture_output=True, text=True, timeout=5,
+                             check=True).stdout
+    except (OSError, subprocess.SubprocessError):
+        return []
+
+    return [dict(zip(fields, map(str.strip, line.split(","))))
+            for line in out.strip().splitlines()]
+
+
+def available_gpu_memory_mib():
+    """GPU memory in MiB this process can use on its first visible GPU.
+
+    TensorFlow reserves most of the GPU memory when the model is loaded,
+    so the memory already held by this process counts as available.
+    Returns None if no GPU is reported.
+    """
+    gpus = nvidia_smi("gpu", ["uuid", "memory.free"])
+    if len(gpus) == 0 or not gpus[0]["memory.free"].isdigit():
+        return None
+
+    own = sum(int(app["used_gpu_memory"])
+              for app in nvidia_smi("compute-apps",
+                                    ["pid", "gpu_uuid", "used_gpu_memory"])
+              if app["pid"] == str(os.getpid())
+              and app["gpu_uuid"] == gpus[0]["uuid"]
+              and app["used_gpu_memory"].isdigit())
+    return int(gpus[0]["memory.free"]) + own
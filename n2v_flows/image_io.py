@@ -0,0 +1,134 @@
+import os
+from os.path import basename, join, splitext
+
+import numpy as np
+import zarr
+from csbdeep.io import save_tiff_imagej_compatible
+from tifffile import imread
+
+# Implicit axes of OME-Zarr versions before 0.3.
+DEFAULT_OME_ZARR_AXES = "TCZYX"
+
+
+def is_zarr(path):
+    return path.rstrip("/").endswith(".zarr")
+
+
+def get_multiscales(axes):
+    """OME-Zarr v0.4 `multiscales` metadata of an image with `axes`.
+
+    Used for TIFF inputs, which carry no OME-Zarr metadata.
+    """
+    types = {"T": "time", "C": "channel"}
+    return {
+        "version": "0.4",
+        "axes": [{"name": a.lower(), "type": types.get(a, "space")}
+                 for a in axes],
+        "datasets": [{
+            "path": "0",
+            "coordinateTransformations": [{"type": "scale",
+                                           "scale": [1.0] * len(axes)}],
+        }],
+    }
+
+
+def get_axes(multiscales):
+    """Axes of a `multiscales` entry as an upper case string, e.g. 'TCZYX'.
+
+    Axes are a list of dicts since v0.4, a list of names in v0.3 and
+    implicit before.
+    """
+    axes = multiscales.get("axes", DEFAULT_OME_ZARR_AXES)
+    return "".join((a["name"] if isinstance(a, dict) else a).upper()
+                   for a in axes)
+
+
+def read_multiscales(path):
+    """The first `multiscales` entry of an OME-Zarr image."""
+    return zarr.open_group(path, mode="r").attrs["multiscales"][0]
+
+
+def open_zarr_image(path, mode="r"):
+    """Open the full resolution array of an OME-Zarr image."""
+    group = zarr.open_group(path, mode=mode)
+    datasets = group.attrs["multiscales"][0]["datasets"]
+    return group[datasets[0]["path"]]
+
+
+def create_zarr_image(path, shape, dtype, multiscales):
+    """Create an OME-Zarr image with one chunk per YX plane.
+
+    The image gets the `multiscales` metadata of its input, reduced to the
+    full resolution dataset, which is stored at path '0'. Separate plane
+    chunks allow several workers to write disjoint planes of the same
+    image concurrently.
+    """
+    group = zarr.open_group(path, mode="w")
+    group.attrs["multiscales"] = [{
+        **multiscales,
+        "datasets": [{**multiscales["datasets"][0], "path": "0"}],
+    }]
+    chunks = (1,) * (len(shape) - 2) + tuple(shape[-2:])
+    return group.create_dataset("0", shape=shape, dtype=dtype, chunks=chunks)
+
+
+def check_axes(axes, shape, target):
+    """Axes of an image with `axes` and `shape` which are not in `target`.
+
+    Such axes can only be dropped if they have size 1, otherwise a
+    ValueError is raised.
+    """
+    if len(axes) != len(shape) or len(set(axes)) != len(axes):
+        raise ValueError(f"Axes {axes} do not match an image of shape "
+                         f"{shape}.")
+
+    dropped = [a for a in axes if a not in target]
+    for a in dropped:
+        if shape[axes.index(a)] != 1:
+            raise ValueError(f"Cannot map axis {a} of size "
+                             f"{shape[axes.index(a)]} of an image with axes "
+                             f"{axes} to {target}.")
+    return dropped
+
+
+def reorder_axes(img, axes, target):
+    """Reorder an image with `axes` to `target`, e.g. 'TCZYX' to 'TZYX'.
+
+    Axes which are not in `target` are dropped and missing axes of
+    `target` are added with size 1.
+    """
+    dropped = check_axes(axes, img.shape, target)
+    img = np.squeeze(img, axis=tuple(axes.index(a) for a in dropped))
+    kept = "".join(a for a in axes if a not in dropped)
+    missing = "".join(a for a in target if a not in kept)
+    img = img.reshape(img.shape + (1,) * len(missing))
+    return np.transpose(img, [(kept + missing).index(a) for a in target])
+
+
+def read_image(path, axes):
+    """Read an image together with its `multiscales` metadata.
+
+    TIFF images are assumed to have `axes`.
+    """
+    if is_zarr(path):
+        return open_zarr_image(path)[...], read_multiscales(path)
+    return imread(path), get_multiscales(axes)
+
+
+def save_image(path, img, multiscales):
+    """Save the image atomically, such that existing outputs are complete."""
+    tmp_path = f"{path}.tmp"
+    if is_zarr(path):
+        create_zarr_image(tmp_path, img.shape, img.dtype,
+                          multiscales=multiscales)[...] = img
+    else:
+        save_tiff_imagej_compatible(tmp_path, img,
+                                    axes=get_axes(multiscales))
+    os.replace(tmp_path, path)
+
+
+def get_save_path(save_dir, file, output_format):
+    name = basename(file.rstrip("/"))
+    if output_format == "zarr" or is_zarr(file):
+        name = f"{splitext(name)[0]}.{output_format}"
+    return join(save_dir, name)
@@ -0,0 +1,89 @@
+import threading
+import time
+from os.path import join
+
+import numpy as np
+
+from n2v_flows.gpu import nvidia_smi
+
+
+def query_gpus():
+    """Utilization and memory of the GPUs assigned to this process."""
+    fields = {"index": "index",
+              "utilization.gpu": "utilization_percent",
+              "memory.used": "memory_used_mib",
+              "memory.total": "memory_total_mib"}
+    return [{key: int(gpu[field]) for field, key in fields.items()}
+            for gpu in nvidia_smi("gpu", list(fields))
+            if all(gpu[field].isdigit() for field in fields)]
+
+
+def read_proc_stats(name):
+    """Parse the `key: value` lines of /proc/self/<name> into integers."""
+    stats = {}
+    try:
+        with open(join("/proc/self", name), "r") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                value = value.split()
+                if len(value) > 0 and value[0].isdigit():
+                    stats[key] = int(value[0])
+    except OSError:
+        pass
+
+    return stats
+
+
+class ResourceMonitor:
+    """Sample GPU, host memory and I/O usage in a background thread."""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.start = time.time()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def _sample(self):
+        status = read_proc_stats("status")
+        io = read_proc_stats("io")
+        self.samples.append({
+            "time_s": time.time() - self.start,
+            "rss_mib": status.get("VmRSS", 0) / 1024,
+            "read_bytes": io.get("read_bytes", 0),
+            "write_bytes": io.get("write_bytes", 0),
+            "rchar": io.get("rchar", 0),
+            "wchar": io.get("wchar", 0),
+            "gpus": query_gpus(),
+        })
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval)
+
+    def to_dict(self):
+        first, last = self.samples[0], self.samples[-1]
+        gpus = [gpu for sample in self.samples for gpu in sample["gpus"]]
+        utilization = [gpu["utilization_percent"] for gpu in gpus]
+        summary = {
+            "duration_s": last["time_s"],
+            "max_rss_mib": max(s["rss_mib"] for s in self.samples),
+            "mean_gpu_utilization_percent": float(
+                np.mean(utilization)) if utilization else None,
+            "max_gpu_memory_used_mib": max(
+                (gpu["memory_used_mib"] for gpu in gpus), default=None),
+        }
+        for key in ["read_bytes", "write_bytes", "rchar", "wchar"]:
+            summary[key] = last[key] - first[key]
+
+        return {"summary": summary, "samples": self.samples}
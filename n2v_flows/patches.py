@@ -0,0 +1,311 @@
+import os
+import random
+from collections import defaultdict
+from contextlib import contextmanager, ExitStack
+from glob import glob
+from os.path import join
+
+import numpy as np
+import prefect
+from n2v_tasks.prefect_task.generate_train_data import \
+    save_train_val_data_task
+from prefect import task
+from tifffile import memmap, TiffFile
+
+from n2v_flows.image_io import (check_axes, get_axes, is_zarr,
+                                open_zarr_image, read_multiscales)
+
+# Axes whose YX planes are sampled. Other axes of OME-Zarr inputs, e.g.
+# channels, must have size 1.
+PLANE_AXES = "TZYX"
+
+
+def image_shape(path):
+    if is_zarr(path):
+        shape = open_zarr_image(path).shape
+        axes = get_axes(read_multiscales(path))
+        check_axes(axes, shape, target=PLANE_AXES)
+        if not axes.endswith("YX"):
+            raise ValueError(f"Expected YX as last axes of {path}, got "
+                             f"{axes}.")
+        return shape
+    with TiffFile(path) as tif:
+        return tif.series[0].shape
+
+
+@contextmanager
+def open_plane_reader(path):
+    """Yield a function reading single YX planes by their flat index.
+
+    Uncompressed TIFFs are memory-mapped, compressed TIFFs are decoded page
+    by page and OME-Zarr images are read chunk by chunk.
+    """
+    if is_zarr(path):
+        img = open_zarr_image(path)
+        yield lambda index: img[np.unravel_index(index, img.shape[:-2])]
+        return
+
+    with TiffFile(path) as tif:
+        series = tif.series[0]
+        try:
+            stack = memmap(path, mode="r").reshape(-1, *series.shape[-2:])
+        except ValueError:
+            stack = None
+
+        if stack is not None:
+            yield lambda index: stack[index]
+        else:
+            yield lambda index: series.pages[index].asarray()
+
+
+def list_planes(files):
+    """List (file, plane index, height, width) of all YX planes."""
+    planes = []
+    for f in files:
+        shape = image_shape(f)
+        planes.extend((f, i, *shape[-2:])
+                      for i in range(int(np.prod(shape[:-2]))))
+
+    return planes
+
+
+def get_n_augment(patch_shape):
+    return 8 if patch_shape[0] == patch_shape[1] else 1
+
+
+def augment_patches(patches):
+    """The 4 rotations of all patches followed by their flips along X.
+
+    Same order as `N2V_DataGenerator.__augment_patches__`.
+    """
+    rotated = np.concatenate([np.rot90(patches, k, axes=(1, 2))
+                              for k in range(4)])
+    return np.concatenate([rotated, rotated[..., ::-1]])
+
+
+def plan_patches(files, num_patches_per_img, patch_shape, seed):
+    """Decide which patches to sample before reading any pixel data.
+
+    Reproduces the sampling of `load_imgs_from_directory` followed by
+    `N2V_DataGenerator.generate_patches_from_list` with the global NumPy
+    RNG seeded with `seed`: the planes of the sorted files are shuffled
+    with `random.Random(seed)`, then every plane draws its patch positions
+    and the shuffle of its augmented patches in turn.
+
+    Returns one work item `(file, [(plane index, slot, ys, xs, order),
+    ...])` per file and the number of planes. The slot of a plane is its
+    position in the shuffle and fixes where its patches end up in the
+    training data.
+    """
+    planes = list_planes(files)
+    random.Random(seed).shuffle(planes)
+    rng = np.random.RandomState(seed)
+    height, width = patch_shape
+    n_augment = get_n_augment(patch_shape)
+
+    work_items = defaultdict(list)
+    for slot, (f, index, h, w) in enumerate(planes):
+        positions = np.array([(rng.randint(0, h - height + 1),
+                               rng.randint(0, w - width + 1))
+                              for _ in range(num_patches_per_img)])
+        order = np.arange(num_patches_per_img * n_augment)
+        rng.shuffle(order)
+        work_items[f].append((index, slot, positions[:, 0], positions[:, 1],
+                              order))
+
+    return [(f, sorted(items, key=lambda item: item[0]))
+            for f, items in work_items.items()], len(planes)
+
+
+def get_patch_files(output_dir, prefix):
+    """Uncompressed train/val patches, which `train_n2v_2D` memory-maps."""
+    return (join(output_dir, f"{prefix}_n2v_train.npy"),
+            join(output_dir, f"{prefix}_n2v_val.npy"))
+
+
+def create_patch_files(output_dir, prefix, n_planes, num_patches_per_img,
+                       patch_shape, val_fraction):
+    """Preallocate the `.npy` files of the patches of `n_planes` planes.
+
+    The patches of the last `val_fraction` planes are used for validation.
+    """
+    n_val = max(1, int(round(val_fraction * n_planes)))
+    n_patches = num_patches_per_img * get_n_augment(patch_shape)
+    for path, n in zip(get_patch_files(output_dir, prefix),
+                       (n_planes - n_val, n_val)):
+        np.lib.format.open_memmap(path, mode="w+", dtype=np.float32,
+                                  shape=(n * n_patches, *patch_shape,
+                                         1)).flush()
+
+
+@contextmanager
+def open_patch_writer(output_dir, prefix):
+    """Yield a function writing the patches of a plane slot to the `.npy`
+    files of `create_patch_files`.
+
+    Slots are written with positioned writes instead of through a memory
+    map. Mapped tasks on different nodes fill disjoint slots of the same
+    files, and writing back whole pages of a memory map over a network file
+    system would overwrite the neighbouring slots of other tasks.
+    """
+    with ExitStack() as stack:
+        files = []
+        for path in get_patch_files(output_dir, prefix):
+            patches = np.load(path, mmap_mode="r")
+            files.append((stack.enter_context(open(path, "r+b")),
+                          patches.offset, patches.nbytes))
+            del patches
+
+        def write(slot, patches):
+            data = np.ascontiguousarray(patches, dtype=np.float32).tobytes()
+            for f, offset, nbytes in files:
+                if (slot + 1) * len(data) <= nbytes:
+                    os.pwrite(f.fileno(), data, offset + slot * len(data))
+                    return
+                slot -= nbytes // len(data)
+            raise IndexError(f"Slot {slot} is out of range.")
+
+        yield write
+
+
+def save_patch_files(output_dir, prefix, save_npy):
+    """Keep the `.npy` patches or convert them with `save_train_val_data_task`.
+    """
+    if save_npy:
+        return
+
+    train_path, val_path = get_patch_files(output_dir, prefix)
+    save_train_val_data_task.run(output_dir=output_dir,
+                                 prefix=prefix,
+                                 X=np.load(train_path, mmap_mode="r"),
+                                 X_val=np.load(val_path, mmap_mode="r"))
+    os.remove(train_path)
+    os.remove(val_path)
+
+
+def crop_patches(file, items, patch_shape, write):
+    """Crop the planned patches of one file and `write` them to their slot.
+
+    Planes are read one at a time. Square patches are augmented with
+    rotations and flips.
+    """
+    height, width = patch_shape
+    with open_plane_reader(file) as read_plane:
+        for index, slot, ys, xs, order in items:
+            plane = read_plane(index).astype(np.float32)
+            patches = np.stack([plane[y:y + height, x:x + width]
+                                for y, x in zip(ys, xs)])
+            if get_n_augment(patch_shape) > 1:
+                patches = augment_patches(patches)
+            write(slot, patches[order, ..., np.newaxis])
+
+
+@task()
+def sample_patches_task(data_dir: str,
+                        filter: str,
+                        num_patches_per_img: int,
+                        patch_shape,
+                        output_dir: str,
+                        prefix: str,
+                        save_npy: bool,
+                        val_fraction: float = 0.1,
+                        seed: int = 42):
+    """Sample N2V patches without loading the images.
+
+    Patches are cropped plane by plane directly into the preallocated
+    `.npy` files, so only one plane is held in memory at a time. The result
+    is identical to the mapped `crop_file_patches_task` path for the same
+    seed.
+    """
+    logger = prefect.context.get("logger")
+
+    files = sorted(glob(join(data_dir, filter)))
+    work_items, n_planes = plan_patches(files,
+                                        num_patches_per_img,
+                                        patch_shape=patch_shape,
+                                        seed=seed)
+    logger.info(f"Found {n_planes} planes for N2V training.")
+    if n_planes < 2:
+        logger.error("At least two images are required for training.")
+
+    create_patch_files(output_dir, prefix,
+                       n_planes=n_planes,
+                       num_patches_per_img=num_patches_per_img,
+                       patch_shape=patch_shape,
+                       val_fraction=val_fraction)
+    with open_patch_writer(output_dir, prefix) as write:
+        for f, items in work_items:
+            crop_patches(f, items, patch_shape=patch_shape, write=write)
+            logger.info(f"Sampled {len(items) * num_patches_per_img} "
+                        f"patches from {f}.")
+
+    save_patch_files(output_dir, prefix, save_npy=save_npy)
+
+
+@task()
+def plan_patches_task(data_dir: str,
+                      filter: str,
+                      num_patches_per_img: int,
+                      patch_shape,
+                      output_dir: str,
+                      prefix: str,
+                      val_fraction: float = 0.1,
+                      seed: int = 42):
+    """Plan the patches of every file and preallocate their `.npy` files."""
+    logger = prefect.context.get("logger")
+
+    files = sorted(glob(join(data_dir, filter)))
+    work_items, n_planes = plan_patches(files,
+                                        num_patches_per_img,
+                                        patch_shape=patch_shape,
+                                        seed=seed)
+    logger.info(f"Found {n_planes} planes in {len(work_items)} files for "
+                f"N2V training.")
+    if n_planes < 2:
+        logger.error("At least two images are required for training.")
+
+    create_patch_files(output_dir, prefix,
+                       n_planes=n_planes,
+                       num_patches_per_img=num_patches_per_img,
+                       patch_shape=patch_shape,
+                       val_fraction=val_fraction)
+    return work_items
+
+
+@task()
+def crop_file_patches_task(work_item,
+                           patch_shape,
+                           output_dir: str,
+                           prefix: str):
+    """Write the patches of one file to its slots of the `.npy` files.
+
+    Only the path of the patches is passed between tasks, the patches
+    themselves are never returned as task results.
+    """
+    file, items = work_item
+    with open_patch_writer(output_dir, prefix) as write:
+        crop_patches(file, items, patch_shape=patch_shape, write=write)
+
+
+@task()
+def save_patch_files_task(cropped,
+                          output_dir: str,
+                          prefix: str,
+                          save_npy: bool):
+    """Reduce step of the mapped `crop_file_patches_task`.
+
+    Every plane is written to the slot decided by `plan_patches`, so the
+    result does not depend on the order in which the mapped tasks finish.
+    """
+    save_patch_files(output_dir, prefix, save_npy=save_npy)
+
+
+@task()
+def save_train_val_npy_task(output_dir: str,
+                            prefix: str,
+                            X,
+                            X_val):
+    """Save uncompressed patches, which `train_n2v_2D` memory-maps."""
+    train_path, val_path = get_patch_files(output_dir, prefix)
+    np.save(train_path, X)
+    np.save(val_path, X_val)
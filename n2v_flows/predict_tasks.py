@@ -0,0 +1,282 @@
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from os.path import join, getmtime, exists, getsize, isdir
+
+import numpy as np
+import prefect
+from distributed import get_worker
+from n2v_tasks.task.predict import load_model
+from prefect import task
+from tifffile import imwrite, memmap, TiffFile
+
+from n2v_flows.image_io import is_zarr, open_zarr_image, \
+    create_zarr_image, get_multiscales, read_multiscales, read_image, \
+    save_image, get_save_path
+from n2v_flows.monitoring import ResourceMonitor
+from n2v_flows.prediction import predict_image, predict_planes, \
+    estimate_batch_size
+
+_model_cache = {}
+
+
+def load_cached_model(model_dir, model_name):
+    """Load the N2V model once per Dask worker.
+
+    The model is kept on the worker, keyed by model directory, model name
+    and modification time of its weights, such that all mapped predict
+    tasks running on this worker reuse it.
+    """
+    try:
+        cache = get_worker().__dict__.setdefault("n2v_model_cache", {})
+    except ValueError:
+        # Not running on a Dask worker.
+        cache = _model_cache
+
+    weights = glob(join(model_dir, model_name, "*.h5"))
+    key = (model_dir, model_name, max(map(getmtime, weights), default=None))
+    if key not in cache:
+        cache.clear()
+        cache[key] = load_model(model_dir=model_dir, model_name=model_name)
+
+    return cache[key]
+
+
+def get_size(path):
+    if isdir(path):
+        return sum(getsize(join(root, name))
+                   for root, _, names in os.walk(path) for name in names)
+    return getsize(path)
+
+
+def shard_by_size(files, n_shards):
+    """Split files into at most `n_shards` shards of similar total size.
+
+    The largest remaining file is always added to the smallest shard.
+    """
+    sizes = {f: get_size(f) for f in files}
+    shards = [[] for _ in range(min(n_shards, len(files)))]
+    loads = [0] * len(shards)
+    for f in sorted(files, key=sizes.get, reverse=True):
+        i = loads.index(min(loads))
+        shards[i].append(f)
+        loads[i] += sizes[f]
+
+    return [sorted(shard) for shard in shards]
+
+
+def predict_file_streaming(model, file, save_path, n_tiles, batch_size,
+                           axes):
+    """Predict a TIFF stack with `axes` batch by batch without loading it.
+
+    Input planes are memory-mapped or, for compressed stacks, decoded page
+    by page. Every predicted batch is written directly to the ImageJ
+    hyperstack or the OME-Zarr image at `save_path`. Peak memory is about
+    one batch of planes, independent of the stack size.
+    """
+    with TiffFile(file) as tif:
+        series = tif.series[0]
+        shape, dtype = series.shape, series.dtype
+        n_planes = int(np.prod(shape[:-2]))
+        if batch_size is None:
+            batch_size = estimate_batch_size(model, shape[-2:], n_tiles)
+        step = max(1, batch_size)
+
+        try:
+            stack = memmap(file, mode="r").reshape(-1, *shape[-2:])
+        except ValueError:
+            stack = None
+
+        def read_planes(start, stop):
+            if stack is not None:
+                return stack[start:stop]
+            return np.stack([series.pages[i].asarray()
+                             for i in range(start, stop)])
+
+        def predicted_batches():
+            out = np.empty((step, *shape[-2:]), dtype=dtype)
+            for start in range(0, n_planes, step):
+                stop = min(start + step, n_planes)
+                predict_planes(model,
+                               planes=read_planes(start, stop),
+                               n_tiles=n_tiles,
+                               batch_size=batch_size,
+                               out=out[:stop - start])
+                yield start, out[:stop - start]
+
+        tmp_path = f"{save_path}.tmp"
+        if is_zarr(save_path):
+            pred = create_zarr_image(tmp_path, shape, dtype,
+                                     multiscales=get_multiscales(axes))
+            for start, planes in predicted_batches():
+                for i, plane in enumerate(planes, start):
+                    pred[np.unravel_index(i, shape[:-2])] = plane
+        else:
+            imwrite(tmp_path,
+                    (plane for _, planes in predicted_batches()
+                     for plane in planes),
+                    shape=shape, dtype=dtype, imagej=True,
+                    metadata={"axes": axes})
+        os.replace(tmp_path, save_path)
+
+
+@task()
+def shard_files_task(files, save_dir, output_format, n_shards,
+                     zarr_regions=False):
+    """Split the files into `n_shards` shards for `predict_files`.
+
+    Files with an existing prediction are skipped, such that an interrupted
+    run resumes where it stopped. With `zarr_regions` OME-Zarr inputs
+    written as OME-Zarr are left out, they are predicted region by region
+    with `predict_region`.
+    """
+    logger = prefect.context.get("logger")
+    if zarr_regions and output_format == "zarr":
+        files = [f for f in files if not is_zarr(f)]
+    todo = [f for f in files
+            if not exists(get_save_path(save_dir, f, output_format))]
+    logger.info(f"Skipping {len(files) - len(todo)} files with existing "
+                f"predictions.")
+    return shard_by_size(todo, n_shards=n_shards)
+
+
+def is_region_done(save_path, shape, start, stop):
+    """True if all plane chunks of the timepoints `start:stop` exist.
+
+    Zarr writes every chunk atomically, so an existing chunk is complete.
+    """
+    return all(exists(join(save_path, "0",
+                           ".".join(map(str, (start + t, *index, 0, 0)))))
+               for t in range(stop - start)
+               for index in np.ndindex(*shape[1:-2]))
+
+
+@task()
+def create_zarr_regions_task(files, save_dir, output_format, region_size):
+    """Create the outputs of all OME-Zarr inputs and split them into regions.
+
+    A region covers `region_size` timepoints of one image and is predicted
+    by one mapped task. Regions never share an output chunk, so different
+    workers can process disjoint regions of the same image concurrently.
+    Regions which have been predicted by an earlier run are skipped.
+    """
+    if output_format != "zarr":
+        return []
+
+    logger = prefect.context.get("logger")
+
+    regions, n_done = [], 0
+    for file in [f for f in files if is_zarr(f)]:
+        img = open_zarr_image(file)
+        save_path = get_save_path(save_dir, file, output_format)
+        if not exists(save_path):
+            create_zarr_image(save_path, img.shape, img.dtype,
+                              multiscales=read_multiscales(file))
+        for start in range(0, img.shape[0], region_size):
+            stop = min(start + region_size, img.shape[0])
+            if is_region_done(save_path, img.shape, start, stop):
+                n_done += 1
+            else:
+                regions.append((file, save_path, start, stop))
+
+    logger.info(f"Skipping {n_done} regions with existing predictions.")
+    return regions
+
+
+@task(log_stdout=True)
+def predict_region(model_dir, model_name, region, n_tiles, batch_size):
+    file, save_path, start, stop = region
+    model = load_cached_model(model_dir=model_dir, model_name=model_name)
+    with ResourceMonitor() as monitor:
+        pred = open_zarr_image(save_path, mode="r+")
+        pred[start:stop] = predict_image(model,
+                                         open_zarr_image(file)[start:stop],
+                                         n_tiles=n_tiles,
+                                         batch_size=batch_size)
+
+    return {"region": [file, start, stop], **monitor.to_dict()}
+
+
+@task(log_stdout=True)
+def predict_files(model_dir, model_name, files, n_tiles, save_dir, batch_size,
+                  prefetch, output_format, axes, streaming=False):
+    """Predict files with overlapped reading, inference and writing.
+
+    A reader thread decodes up to `prefetch` upcoming files while the GPU
+    predicts the current one, and a writer thread saves up to `prefetch`
+    previous results. Both queues are bounded to cap the memory. TIFF
+    inputs are assumed to have `axes`.
+
+    With `streaming` every TIFF stack is predicted with
+    `predict_file_streaming` instead, such that stacks larger than the
+    memory can be processed. OME-Zarr inputs cannot be streamed to TIFF in
+    plane order, they are still predicted in memory.
+
+    Returns the time spent waiting for reads, predicting and waiting for
+    writes of every file, together with the samples of `ResourceMonitor`.
+    """
+    logger = prefect.context.get("logger")
+    model = load_cached_model(model_dir=model_dir, model_name=model_name)
+    prefetch = max(1, prefetch)
+
+    timings = []
+    with ResourceMonitor() as monitor, \
+            ThreadPoolExecutor(max_workers=1) as reader, \
+            ThreadPoolExecutor(max_workers=1) as writer:
+        if streaming:
+            if any(map(is_zarr, files)):
+                logger.warning("OME-Zarr inputs are not streamed to "
+                               f"{output_format}, they are predicted in "
+                               "memory.")
+            for file in [f for f in files if not is_zarr(f)]:
+                start = time.time()
+                predict_file_streaming(model, file,
+                                       save_path=get_save_path(
+                                           save_dir, file, output_format),
+                                       n_tiles=n_tiles,
+                                       batch_size=batch_size,
+                                       axes=axes)
+                timings.append({"file": file,
+                                "predict_s": time.time() - start})
+            files = [f for f in files if is_zarr(f)]
+
+        reads = deque(reader.submit(read_image, f, axes)
+                      for f in files[:prefetch])
+        writes = deque()
+        for i, file in enumerate(files):
+            start = time.time()
+            img, multiscales = reads.popleft().result()
+            read = time.time()
+            if i + prefetch < len(files):
+                reads.append(reader.submit(read_image, files[i + prefetch],
+                                           axes))
+
+            pred = predict_image(model, img, n_tiles=n_tiles,
+                                 batch_size=batch_size)
+            predicted = time.time()
+            writes.append(writer.submit(save_image,
+                                        get_save_path(save_dir, file,
+                                                      output_format),
+                                        pred,
+                                        multiscales=multiscales))
+            while len(writes) > prefetch:
+                writes.popleft().result()
+            timings.append({"file": file,
+                            "read_wait_s": read - start,
+                            "predict_s": predicted - read,
+                            "write_wait_s": time.time() - predicted})
+
+        for write in writes:
+            write.result()
+
+    return {"files": timings, **monitor.to_dict()}
+
+
+@task()
+def save_performance_task(output_dir, files, regions=()):
+    """Save the timings and resource samples of all predict tasks."""
+    with open(join(output_dir, "performance.json"), "w") as f:
+        json.dump({"files": files, "regions": list(regions)}, f, indent=4)
@@ -0,0 +1,181 @@
+import warnings
+from typing import Callable, NamedTuple, Optional
+
+import csbdeep
+import n2v
+import numpy as np
+import tensorflow as tf
+from csbdeep.data import PadAndCropResizer
+from csbdeep.internals.predict import predict_direct
+
+from n2v_flows.gpu import available_gpu_memory_mib
+
+MAX_BATCH_SIZE = 64
+
+# Part of the available GPU memory used for the activations of a batch.
+MEMORY_FRACTION = 0.8
+
+# Versions (major.minor) of n2v and csbdeep whose private model helpers
+# were checked for `ModelInternals`, see requirements.txt.
+SUPPORTED_VERSIONS = {"n2v": (n2v.__version__, "0.3"),
+                      "csbdeep": (csbdeep.__version__, "0.6")}
+
+
+class ModelInternals(NamedTuple):
+    """Private helpers of `N2V`/`CARE` used to predict batches of planes.
+
+    `N2V.predict` predicts one image at a time. Batched prediction reuses
+    its normalization and the divisibility of its U-Net, which are private
+    methods. They are only accessed through this adapter.
+    """
+    normalize: Callable
+    denormalize: Callable
+    axes_div_by: Callable
+
+
+def get_model_internals(model) -> Optional[ModelInternals]:
+    """`ModelInternals` of `model` or None for unchecked n2v/csbdeep versions.
+
+    Without them every plane is predicted on its own with `N2V.predict`.
+    """
+    unsupported = [f"{package} {version}"
+                   for package, (version, supported)
+                   in SUPPORTED_VERSIONS.items()
+                   if not version.startswith(supported + ".")]
+    names = ("__normalize__", "__denormalize__", "_axes_div_by")
+    unsupported += [f"{type(model).__name__}.{name}" for name in names
+                    if not hasattr(model, name)]
+    if len(unsupported) > 0:
+        warnings.warn(f"Batched prediction is not supported with "
+                      f"{', '.join(unsupported)}, predicting plane by plane.")
+        return None
+
+    return ModelInternals(*(getattr(model, name) for name in names))
+
+
+def unet_activations_per_pixel(config, n_conv_per_depth=2):
+    """Float32 values per plane pixel of all layer outputs of the U-Net.
+
+    Follows the layers built by `csbdeep.internals.blocks.unet_block` for
+    an N2V config (`n_conv_per_depth` is fixed to 2 by n2v). A conv block
+    outputs the convolution and, with batch normalization, also the
+    normalized and the activated tensor. Every pooling divides the number
+    of pixels by `2 ** n_dim`. Not all of them are alive at the same time,
+    so this is an upper bound of the activation memory. For the default
+    config (depth 2, batch norm) it is 23.25 values per first-layer filter.
+    """
+    f = config.unet_n_first
+    depth = config.unet_n_depth
+    per_block = 3 if config.batch_norm else 1
+    pool = 2 ** config.n_dim
+
+    total = 0.0
+    for n in range(depth):
+        # Conv blocks and max pooling on the way down.
+        total += (per_block * n_conv_per_depth * f * 2 ** n +
+                  f * 2 ** n / pool) / pool ** n
+    total += per_block * ((n_conv_per_depth - 1) * f * 2 ** depth +
+                          f * 2 ** max(0, depth - 1)) / pool ** depth
+    for n in reversed(range(depth)):
+        # Upsampling, concatenation with the skip layer and conv blocks.
+        total += (f * 2 ** n + 2 * f * 2 ** n +
+                  per_block * ((n_conv_per_depth - 1) * f * 2 ** n +
+                               f * 2 ** max(0, n - 1))) / pool ** n
+
+    return total
+
+
+def estimate_batch_size(model, plane_shape, n_tiles):
+    """Number of YX planes which fit into one forward pass on the GPU.
+
+    Estimated from the GPU memory available to this process and the
+    activations of the U-Net for a padded plane. Tiled planes, runs
+    without a GPU and models without `ModelInternals` are predicted one
+    plane at a time.
+    """
+    if np.prod(n_tiles) > 1:
+        return 1
+
+    available = available_gpu_memory_mib()
+    internals = get_model_internals(model)
+    if available is None or internals is None:
+        return 1
+
+    div_by = internals.axes_div_by("YX")
+    n_pixels = np.prod([-(-s // d) * d for s, d in zip(plane_shape, div_by)])
+    plane_mib = (n_pixels * unet_activations_per_pixel(model.config) *
+                 np.dtype(np.float32).itemsize / 2 ** 20)
+    return int(np.clip(MEMORY_FRACTION * available // plane_mib, 1,
+                       MAX_BATCH_SIZE))
+
+
+def predict_batch(model, internals, planes):
+    """Predict a batch of YX planes in a single forward pass.
+
+    Uses the normalization, padding and prediction helpers of
+    `N2V.predict` with an additional sample axis.
+    """
+    axes = "S" + model.config.axes
+    x = planes.astype(np.float32)[..., np.newaxis]
+    means = np.array([float(m) for m in model.config.means], ndmin=x.ndim,
+                     dtype=np.float32)
+    stds = np.array([float(s) for s in model.config.stds], ndmin=x.ndim,
+                    dtype=np.float32)
+
+    resizer = PadAndCropResizer()
+    x = resizer.before(internals.normalize(x, means, stds), axes,
+                       internals.axes_div_by(axes))
+    pred = predict_direct(model.keras_model, x, axes_in=axes,
+                          batch_size=len(x))
+    pred = resizer.after(pred, axes)
+    return internals.denormalize(pred, means, stds)[..., 0]
+
+
+def predict_planes(model, planes, n_tiles, batch_size, out):
+    """Predict a stack of YX planes into `out`.
+
+    Planes are predicted `batch_size` at a time, or as many as fit into
+    GPU memory if `batch_size` is None. The batch size is halved whenever
+    a batch does not fit into GPU memory. If a single plane already has to
+    be tiled (`n_tiles`), the batch size is 1 or the model has no
+    `ModelInternals`, every plane is predicted on its own with
+    `model.predict`.
+    """
+    if batch_size is None:
+        batch_size = estimate_batch_size(model, planes.shape[-2:], n_tiles)
+
+    iinfo = np.iinfo(out.dtype)
+    internals = get_model_internals(model)
+    tiled = np.prod(n_tiles) > 1 or batch_size <= 1 or internals is None
+
+    start = 0
+    while start < len(planes):
+        try:
+            if tiled:
+                pred = model.predict(planes[start].astype(np.float32),
+                                     axes="YX",
+                                     n_tiles=n_tiles)[np.newaxis]
+            else:
+                pred = predict_batch(model, internals,
+                                     planes[start:start + batch_size])
+        except tf.errors.ResourceExhaustedError:
+            if tiled or batch_size == 1:
+                raise
+            batch_size = batch_size // 2
+            continue
+
+        out[start:start + len(pred)] = np.clip(pred,
+                                               a_min=iinfo.min,
+                                               a_max=iinfo.max).astype(
+            out.dtype)
+        start += len(pred)
+
+
+def predict_image(model, img, n_tiles, batch_size):
+    pred = np.zeros_like(img)
+    predict_planes(model,
+                   planes=img.reshape(-1, *img.shape[-2:]),
+                   n_tiles=n_tiles,
+                   batch_size=batch_size,
+                   out=pred.reshape(-1, *pred.shape[-2:]))
+    return pred
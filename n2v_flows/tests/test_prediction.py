@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("n2v")
+
+from n2v.models import N2V, N2VConfig  # noqa: E402
+
+from n2v_flows import prediction  # noqa: E402
+
+SEED = 0
+
+
+@pytest.fixture(scope="module")
+def model(tmp_path_factory):
+    rng = np.random.RandomState(SEED)
+    X = rng.poisson(100, size=(8, 16, 16, 1)).astype(np.float32)
+    config = N2VConfig(X,
+                       unet_n_depth=2,
+                       unet_n_first=8,
+                       train_tensorboard=False,
+                       n2v_patch_shape=(16, 16))
+    return N2V(config, "model",
+               basedir=str(tmp_path_factory.mktemp("models")))
+
+
+def test_unet_activations_per_pixel_matches_model(model):
+    keras_model = model.keras_model
+    probe = tf.keras.Model(keras_model.inputs,
+                           [layer.output for layer in keras_model.layers[1:]])
+    shape = (32, 32)
+    outputs = probe.predict(np.zeros((1, *shape, 1), dtype=np.float32))
+    measured = sum(out.size for out in outputs) / np.prod(shape)
+
+    # Besides the U-Net, the model only adds a few single-channel layers.
+    estimated = prediction.unet_activations_per_pixel(model.config)
+    assert estimated <= measured <= estimated + 4
+
+
+def predict_with_batch_size(model, planes, batch_size):
+    out = np.zeros_like(planes)
+    prediction.predict_planes(model, planes, n_tiles=(1, 1),
+                              batch_size=batch_size, out=out)
+    return out
+
+
+def test_batched_prediction_matches_plane_by_plane(model):
+    planes = np.random.RandomState(SEED).poisson(
+        100, size=(5, 24, 20)).astype(np.uint16)
+
+    np.testing.assert_allclose(predict_with_batch_size(model, planes, 4),
+                               predict_with_batch_size(model, planes, 1),
+                               atol=1)
+
+
+def test_unsupported_versions_predict_plane_by_plane(model, monkeypatch):
+    monkeypatch.setitem(prediction.SUPPORTED_VERSIONS, "csbdeep",
+                        ("0.5.0", "0.6"))
+    with pytest.warns(UserWarning, match="csbdeep 0.5.0"):
+        assert prediction.get_model_internals(model) is None
+
+    planes = np.zeros((3, 16, 16), dtype=np.uint16)
+    with pytest.warns(UserWarning):
+        assert predict_with_batch_size(model, planes, 4).shape == planes.shape
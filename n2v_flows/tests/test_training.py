@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("n2v")
+
+from n2v.models import N2V, N2VConfig  # noqa: E402
+
+from n2v_flows.training import (  # noqa: E402
+    KnownStatsArray, channel_mean_std, train_memmapped_model)
+
+SEED = 0
+
+
+def create_patches(path, n, shape):
+    rng = np.random.RandomState(SEED)
+    X = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32,
+                                  shape=(n, *shape, 1))
+    X[...] = rng.poisson(100, size=X.shape)
+    X.flush()
+    return np.load(path, mmap_mode="r")
+
+
+def build_model(X, basedir, name):
+    config = N2VConfig(X,
+                       unet_n_depth=2,
+                       unet_n_first=8,
+                       train_epochs=1,
+                       train_steps_per_epoch=1,
+                       train_batch_size=4,
+                       train_tensorboard=False,
+                       n2v_patch_shape=(16, 16))
+    return N2V(config, name, basedir=str(basedir))
+
+
+def test_channel_mean_std_matches_numpy(tmp_path):
+    X = create_patches(tmp_path / "train.npy", n=100, shape=(8, 8))
+    mean, std = channel_mean_std(X, chunk_size=7)
+    np.testing.assert_allclose(mean, np.mean(X, dtype=np.float64))
+    np.testing.assert_allclose(std, np.std(X, dtype=np.float64))
+
+
+def test_known_stats_array_sets_config_normalization(tmp_path):
+    X = create_patches(tmp_path / "train.npy", n=16, shape=(16, 16))
+    config = N2VConfig(KnownStatsArray(X, mean=12.5, std=3.0))
+    assert [float(m) for m in config.means] == [12.5]
+    assert [float(s) for s in config.stds] == [3.0]
+
+
+def test_multi_channel_patches_are_rejected(tmp_path):
+    X = np.zeros((4, 16, 16, 2), dtype=np.float32)
+    with pytest.raises(ValueError):
+        channel_mean_std(X)
+
+
+def test_training_step_matches_n2v_train(tmp_path):
+    X = create_patches(tmp_path / "train.npy", n=16, shape=(32, 32))
+    X_val = create_patches(tmp_path / "val.npy", n=4, shape=(32, 32))
+
+    reference = build_model(np.asarray(X), tmp_path, "reference")
+    memmapped = build_model(np.asarray(X), tmp_path, "memmapped")
+    memmapped.keras_model.set_weights(reference.keras_model.get_weights())
+
+    np.random.seed(SEED)
+    tf.random.set_seed(SEED)
+    reference.train(np.asarray(X), np.asarray(X_val))
+
+    np.random.seed(SEED)
+    tf.random.set_seed(SEED)
+    train_memmapped_model(memmapped, X=X, X_val=X_val, prefetch=2)
+
+    for expected, actual in zip(reference.keras_model.get_weights(),
+                                memmapped.keras_model.get_weights()):
+        np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
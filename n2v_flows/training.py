@@ -0,0 +1,195 @@
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from csbdeep.utils import axes_check_and_normalize, axes_dict
+from csbdeep.utils.tf import CARETensorBoardImage
+from n2v.internals.N2V_DataWrapper import N2V_DataWrapper
+from n2v.utils import n2v_utils
+
+# Number of patches read at once to compute the normalization.
+STATS_CHUNK_SIZE = 256
+
+
+def check_single_channel(X):
+    """The memory-mapped training supports single-channel patches only."""
+    if X.shape[-1] != 1:
+        raise ValueError(f"Expected single-channel training patches, got "
+                         f"{X.shape[-1]} channels.")
+
+
+def channel_mean_std(X, chunk_size=STATS_CHUNK_SIZE):
+    """Mean and standard deviation of single-channel patches.
+
+    Computed `chunk_size` patches at a time and combined with the pairwise
+    update of Chan et al., such that memory-mapped patches are never held
+    in memory as a whole.
+    """
+    check_single_channel(X)
+    n, mean, m2 = 0, 0.0, 0.0
+    for start in range(0, len(X), chunk_size):
+        chunk = np.asarray(X[start:start + chunk_size], dtype=np.float64)
+        chunk_mean = chunk.mean()
+        delta = chunk_mean - mean
+        total = n + chunk.size
+        mean += delta * chunk.size / total
+        m2 += ((chunk - chunk_mean) ** 2).sum() + delta ** 2 * n * \
+            chunk.size / total
+        n = total
+
+    return mean, np.sqrt(m2 / n)
+
+
+class KnownStatsArray(np.ndarray):
+    """View of single-channel patches with a precomputed mean and std.
+
+    `N2VConfig` computes the normalization of the training patches with
+    `np.mean` and `np.std`, which allocate float temporaries of their full
+    size. For this view, and the channel views taken from it, both return
+    the precomputed values instead.
+    """
+
+    def __new__(cls, X, mean, std):
+        check_single_channel(X)
+        view = np.asarray(X).view(cls)
+        view._mean, view._std = mean, std
+        return view
+
+    def __array_finalize__(self, obj):
+        self._mean = getattr(obj, "_mean", None)
+        self._std = getattr(obj, "_std", None)
+
+    def __array_function__(self, func, types, args, kwargs):
+        if func is np.mean:
+            return self._mean
+        if func is np.std:
+            return self._std
+        return super().__array_function__(func, types, args, kwargs)
+
+
+class NormalizedArray:
+    """Read-only view of a (memory-mapped) array, normalized on access."""
+
+    def __init__(self, data, mean, std):
+        self.data = data
+        self.mean = mean
+        self.std = std
+        self.shape = data.shape
+        self.ndim = data.ndim
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        return (np.asarray(self.data[key], dtype=np.float32) -
+                self.mean) / self.std
+
+
+def copy_batch(sequence, i):
+    x, y = sequence[i]
+    return x.copy(), y.copy()
+
+
+def prefetch_batches(sequence, prefetch):
+    """Yield the batches of `sequence` while a thread prepares the next ones.
+
+    `N2V_DataWrapper` reuses its batch buffers, hence every batch is copied
+    before it is queued. At most `prefetch` batches are queued.
+    """
+    prefetch = max(1, prefetch)
+    with ThreadPoolExecutor(max_workers=1) as loader:
+        batches = deque(loader.submit(copy_batch, sequence, i)
+                        for i in range(min(prefetch, len(sequence))))
+        for i in range(len(sequence)):
+            batch = batches.popleft().result()
+            if i + prefetch < len(sequence):
+                batches.append(loader.submit(copy_batch, sequence,
+                                             i + prefetch))
+            yield batch
+
+
+def open_memmapped_train_data(train_data: str, val_data: str):
+    """Memory-map uncompressed `.npy` patches instead of loading them."""
+    return np.load(train_data, mmap_mode="r"), np.load(val_data, mmap_mode="r")
+
+
+def train_memmapped_model(model, X, X_val, prefetch):
+    """Train N2V on memory-mapped single-channel training patches.
+
+    Follows `N2V.train` of the n2v version pinned in requirements.txt step
+    by step, except that the training patches are read and normalized batch
+    by batch instead of being normalized and duplicated in memory up front.
+    A loader thread prepares up to `prefetch` batches ahead of the GPU. The
+    (small) validation set is loaded into memory. `tests/test_training.py`
+    checks that a training step matches `N2V.train`.
+    """
+    check_single_channel(X)
+    config = model.config
+
+    n_train, n_val = len(X), len(X_val)
+    if n_val / (n_train + n_val) < 0.05:
+        warnings.warn(f"small number of validation images (only "
+                      f"{100 * n_val / (n_train + n_val):.1f}% of all "
+                      f"images)")
+    axes = axes_check_and_normalize("S" + config.axes, X.ndim)
+    ax = axes_dict(axes)
+    div_by = 2 ** config.unet_n_depth
+    for a in "XYZT":
+        if a in axes and X.shape[ax[a]] % div_by != 0:
+            raise ValueError(f"training images must be evenly divisible by "
+                             f"{div_by} along axis {a}")
+
+    if not model._model_prepared:
+        model.prepare_for_training()
+
+    manipulator = getattr(n2v_utils, f"pm_{config.n2v_manipulator}")(
+        config.n2v_neighborhood_radius)
+    mean = float(config.means[0])
+    std = float(config.stds[0])
+
+    X = NormalizedArray(X, mean=mean, std=std)
+    mask = np.array(config.structN2Vmask) if config.structN2Vmask else None
+    training_data = N2V_DataWrapper(
+        X, X,
+        batch_size=config.train_batch_size,
+        length=config.train_steps_per_epoch * config.train_epochs,
+        perc_pix=config.n2v_perc_pix,
+        shape=config.n2v_patch_shape,
+        value_manipulation=manipulator,
+        structN2Vmask=mask)
+
+    validation_X = NormalizedArray(X_val, mean=mean, std=std)[...]
+    validation_Y = np.concatenate((validation_X,
+                                   np.zeros_like(validation_X)), axis=-1)
+    n2v_utils.manipulate_val_data(validation_X, validation_Y,
+                                  perc_pix=config.n2v_perc_pix,
+                                  shape=validation_X.shape[1:-1],
+                                  value_manipulation=manipulator)
+    model.callbacks.append(CARETensorBoardImage(
+        model=model.keras_model,
+        data=(validation_X, validation_X),
+        log_dir=str(model.logdir / "logs" / "images"),
+        n_images=3,
+        prob_out=False))
+
+    history = model.keras_model.fit(
+        prefetch_batches(training_data, prefetch=prefetch),
+        validation_data=(validation_X, validation_Y),
+        epochs=config.train_epochs,
+        steps_per_epoch=config.train_steps_per_epoch,
+        callbacks=model.callbacks,
+        verbose=1)
+
+    if model.basedir is not None:
+        model.keras_model.save_weights(str(model.logdir / "weights_last.h5"))
+        if config.train_checkpoint is not None:
+            model._find_and_load_weights(config.train_checkpoint)
+            try:
+                # remove temporary weights
+                (model.logdir / "weights_now.h5").unlink()
+            except FileNotFoundError:
+                pass
+
+    return history